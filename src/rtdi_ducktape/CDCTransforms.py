@@ -18,7 +18,7 @@ class Comparison(Table):
                  logical_pk_list: Union[None, Iterable[str]] = None, columns_to_ignore: Union[None, list[str]] = None,
                  order_column: Union[None, str] = None, before_image: bool = True, detect_deletes: bool = False,
                  end_date_column: Union[None, str] = None, termination_date: Union[None, datetime] = None,
-                 logger: Union[None, Logger] = None
+                 logger: Union[None, Logger] = None, materialize_ctes: bool = True, analyze_after: bool = True
                  ):
         """
         Compare the input with another table, that has at least the same columns as the input and generate the CDC
@@ -59,6 +59,11 @@ class Comparison(Table):
         :param end_date_column: The end date column of the SCD2
         :param termination_date: The value of the end date column in case it is active
         :param logger: Logger of the dataflow
+        :param materialize_ctes: evaluate the source dataset once and reuse the result in all parts of the delta
+        statement. For small in-memory tables this makes no difference, for sources reading Parquet files or remote
+        data it avoids scanning the data multiple times. The comparison dataset is materialized only when
+        detect_deletes is set, else only its rows matching a source primary key are read
+        :param analyze_after: refresh the optimizer statistics of the output table after it got written
         """
         if logger is None:
             self.logger = logging.getLogger("Comparison")
@@ -76,7 +81,7 @@ class Comparison(Table):
         self.add_input(source)
         self.source = source
         self.comparison: Union[None, Dataset] = None
-        self.columns_to_ignore = columns_to_ignore
+        self.columns_to_ignore = frozenset(columns_to_ignore) if columns_to_ignore else frozenset()
         self.order_column = order_column
         self.before_image = before_image
         self.detect_deletes = detect_deletes
@@ -84,6 +89,12 @@ class Comparison(Table):
         self.termination_date = termination_date
         if self.termination_date is None:
             self.termination_date = datetime.strptime('9999-12-31', '%Y-%m-%d')
+        self.materialize_ctes = materialize_ctes
+        self.analyze_after = analyze_after
+        self._compiled_settings: Union[None, tuple] = None
+        self._compiled_columns: Union[None, tuple[set[str], set[str]]] = None
+        self._compiled_ddl: Union[None, list[str]] = None
+        self._compiled_sql: dict[bool, str] = dict()
 
     def set_source(self, source: Dataset):
         if self.source is not None:
@@ -91,71 +102,106 @@ class Comparison(Table):
             self.inputs.discard(self.source)
         self.source = source
         self.add_input(source)
+        self._invalidate()
 
     def set_comparison_table(self, comparison: Dataset):
         self.comparison = comparison
+        self._invalidate()
 
-    def execute(self, duckdb):
-        self.logger.info(f"Comparison() - Started for {self.source.name}")
-        if self.pk_list is None:
-            if isinstance(self.comparison, Table):
-                self.logger.debug(f"Comparison() - No logical primary key provided, reading the pk of "
-                                  f"the comparison table {self.comparison}...")
-                self.pk_list = self.comparison.get_table_primary_key(duckdb)
-
-                if self.pk_list is not None:
-                    self.logger.debug(f"Comparison() - Comparison table {self.comparison} has the "
-                                      f"primary key columns {self.pk_list}")
-            elif isinstance(self.source, Table):
-                self.logger.debug(f"Comparison() - No logical primary key provided, reading the pk of "
-                                  f"the source table {self.source}...")
-                self.pk_list = self.source.get_table_primary_key(duckdb)
+    def _invalidate(self):
+        self._compiled_settings = None
+        self._compiled_columns = None
+        self._compiled_ddl = None
+        self._compiled_sql.clear()
 
-                if self.pk_list is not None:
-                    self.logger.debug(f"Comparison() - source table {self.source} has the "
-                                      f"primary key columns {self.pk_list}")
-        if self.pk_list is None:
-            raise RuntimeError("No logical PK can be derived from the source or the comparison table, hence the "
-                               "logical_pk_list must be provided")
-        self.last_execution = OperationalMetadata()
+    def _compile(self, duckdb, comparison_is_smaller: bool) -> tuple[list[str], str]:
+        """
+        Build the statements once and reuse them as long as all inputs of the generated SQL are unchanged: the
+        settings, the primary key, the columns and the SQL of the source and comparison datasets. The settings are
+        public attributes, hence they are compared at every execution instead of relying on setters. The
+        termination date is bound as parameter at execution.
 
+        :return: the statements to prepare the output table and the statement to fill it
+        """
+        source_columns = self.source.get_cols(duckdb)
+        comparison_columns = self.comparison.get_cols(duckdb)
+        settings = (tuple(self.pk_list), self.before_image, self.detect_deletes, self.order_column,
+                    self.end_date_column, frozenset(self.columns_to_ignore), self.materialize_ctes, self.table_name,
+                    source_columns, comparison_columns,
+                    self.source.get_sub_select_clause(), self.comparison.get_sub_select_clause())
+        if settings != self._compiled_settings:
+            self._compiled_sql.clear()
+            input_columns = set(source_columns)
+            input_columns.discard(CHANGE_TYPE)  # in case the target table stores the change type, do not compare on that
+            comparison_table_columns = set(comparison_columns)
+            output_table_str = quote_str(self.table_name)
+            ddl = [f"CREATE OR REPLACE TABLE {output_table_str} AS FROM {self.comparison.get_sub_select_clause()} "
+                   f"with no data"]
+            # The change type column, if present in the target, is always ignored in the comparison and also not selected from
+            if CHANGE_TYPE in comparison_table_columns:
+                comparison_table_columns.discard(CHANGE_TYPE)
+            else:
+                ddl.append(f"ALTER TABLE {output_table_str} add {CHANGE_TYPE_COLUMN} varchar(1)")
+            self._compiled_columns = (input_columns, comparison_table_columns)
+            self._compiled_ddl = ddl
+            self._compiled_settings = settings
+        delta_sql = self._compiled_sql.get(comparison_is_smaller)
+        if delta_sql is None:
+            delta_sql = self._build_sql(*self._compiled_columns, comparison_is_smaller)
+            self._compiled_sql[comparison_is_smaller] = delta_sql
+        return self._compiled_ddl, delta_sql
+
+    def _build_sql(self, input_columns: set[str], comparison_table_columns: set[str],
+                   comparison_is_smaller: bool) -> str:
         input_pks_str = convert_list_to_str(self.pk_list)
-        input_columns = self.source.get_cols(duckdb)
-        input_columns.discard(CHANGE_TYPE)  # in case the target table stores the change type, do not compare on that
         input_fields_str_s = convert_list_to_str(input_columns, "s")
-        comparison_table_columns = self.comparison.get_cols(duckdb)
-        # The change type column, if present in the target, is always ignored in the comparison and also not selected from
-        if CHANGE_TYPE in comparison_table_columns:
-            comparison_table_has_change_type = True
-            comparison_table_columns.discard(CHANGE_TYPE_COLUMN)
-        else:
-            comparison_table_has_change_type = False
-
-        if self.columns_to_ignore is None or len(self.columns_to_ignore) == 0:
-            compare_columns = input_columns
-        else:
-            compare_columns = input_columns.difference(self.columns_to_ignore)
+        input_fields_str_t = convert_list_to_str(input_columns, "t")
+        compare_columns = input_columns.difference(self.columns_to_ignore)
         compare_columns_str = convert_list_to_str(compare_columns)
 
         additional_columns = comparison_table_columns.difference(input_columns)
-        additional_columns.discard(CHANGE_TYPE)
-        additional_columns_projection = ""
-        for field in additional_columns:
-            additional_columns_projection += f", null as {field}"
-        additional_fields_str_t = convert_list_to_str(additional_columns, "t")
-        if additional_fields_str_t is not None and len(additional_fields_str_t) > 0:
-            additional_fields_str_t = ", " + additional_fields_str_t
-        join_condition_s_t = create_join_condition(self.pk_list, "s", "t")
-        join_condition_k_t = join_condition_s_t.replace('s.', 'k.')
+        additional_columns_projection = "".join([f", null as {quote_str(field)}" for field in additional_columns])
+        additional_fields_str_t = ""
+        additional_fields_str_s = ""
+        additional_fields_str = ""
+        if len(additional_columns) > 0:
+            additional_fields_str_t = ", " + convert_list_to_str(additional_columns, "t")
+            additional_fields_str_s = ", " + convert_list_to_str(additional_columns, "s")
+            additional_fields_str = ", " + convert_list_to_str(additional_columns)
+        join_condition_s_t = self.get_join_condition("s", "t")
+        join_condition_k_t = self.get_join_condition("k", "t")
+        # DuckDB decides the build side on its estimates but keeps the written order on ties, so list the smaller first
+        if comparison_is_smaller:
+            source_join_current = f"current_version as t join source as s on {join_condition_s_t}"
+        else:
+            source_join_current = f"source as s join current_version as t on {join_condition_s_t}"
 
         order_clause = ""
         if self.order_column is not None:
             order_clause = f"order by {quote_str(self.order_column)} desc"
-        tc_filter = ""
+        comparison_filters = []
+        source_pks_cte = ""
         if self.end_date_column is not None:
-            tc_filter = f"where \"{self.end_date_column}\" = ?"
+            comparison_filters.append(f"\"{self.end_date_column}\" = ?")
+        if not self.detect_deletes:
+            # Only the comparison rows matching a source pk are needed, which allows to skip most of the comparison
+            # table when the source is a small delta. Detecting deletes requires the full comparison table, though.
+            source_pks_cte = f"source_pks as (select distinct {input_pks_str} from source),"
+            comparison_filters.append(f"({input_pks_str}) in (select {input_pks_str} from source_pks)")
+        tc_filter = ""
+        if len(comparison_filters) > 0:
+            tc_filter = "where " + " and ".join(comparison_filters)
+        source_materialized = ""
+        comparison_materialized = ""
+        if self.materialize_ctes:
+            source_materialized = "materialized "
+            if self.detect_deletes:
+                # Materializing the comparison table would read it in full and defeat the source_pks filter
+                comparison_materialized = "materialized "
         select = f"""
-        with comparison_table as {self.comparison.get_sub_select_clause()},
+        with comparison_table as {comparison_materialized}{self.comparison.get_sub_select_clause()},
+        source as {source_materialized}{self.source.get_sub_select_clause()},
+        {source_pks_cte}
         current_version as 
         (select * from
             (select *, row_number() over (partition by {input_pks_str} {order_clause}) as \"__rownumber\" 
@@ -163,7 +209,6 @@ class Comparison(Table):
             )
         where \"__rownumber\" = 1
         ),
-        source as {self.source.get_sub_select_clause()},
         changed as (select {compare_columns_str} from source as s
                     except
                     select {compare_columns_str} from current_version as s
@@ -172,42 +217,70 @@ class Comparison(Table):
         from source as s where ({input_pks_str}) not in (select {input_pks_str} from current_version)
         union all
         select {input_fields_str_s}{additional_fields_str_t}, '{RowType.UPDATE.value}' as {CHANGE_TYPE_COLUMN} 
-        from source as s join current_version as t on {join_condition_s_t} join changed k on {join_condition_k_t}
+        from {source_join_current} join changed k on {join_condition_k_t}
         """
         if self.before_image:
             select += f"""
                 union all
-                select {input_fields_str_s.replace('s.', 't.')}{additional_fields_str_t},
+                select {input_fields_str_t}{additional_fields_str_t},
                     '{RowType.BEFORE.value}' as {CHANGE_TYPE_COLUMN}
-                from source as s join current_version as t on {join_condition_s_t}
+                from {source_join_current}
                 join changed k on {join_condition_k_t}
             """
         if self.detect_deletes:
             select += f"""
                 union all
-                select {input_fields_str_s}{additional_fields_str_t.replace("t.", "s.")},
+                select {input_fields_str_s}{additional_fields_str_s},
                     '{RowType.DELETE.value}' as {CHANGE_TYPE_COLUMN} from comparison_table as s
                 where ({input_pks_str}) not in (select {input_pks_str} from source)
             """
+        output_list = convert_list_to_str(input_columns) + additional_fields_str + f", {CHANGE_TYPE_COLUMN}"
+        return f"insert into {quote_str(self.table_name)}({output_list}) {select}"
+
+    def execute(self, duckdb):
+        self.logger.info(f"Comparison() - Started for {self.source.name}")
+        if self.pk_list is None:
+            if isinstance(self.comparison, Table):
+                self.logger.debug(f"Comparison() - No logical primary key provided, reading the pk of "
+                                  f"the comparison table {self.comparison}...")
+                self.pk_list = self.comparison.get_table_primary_key(duckdb)
+
+                if self.pk_list is not None:
+                    self.logger.debug(f"Comparison() - Comparison table {self.comparison} has the "
+                                      f"primary key columns {self.pk_list}")
+            elif isinstance(self.source, Table):
+                self.logger.debug(f"Comparison() - No logical primary key provided, reading the pk of "
+                                  f"the source table {self.source}...")
+                self.pk_list = self.source.get_table_primary_key(duckdb)
+
+                if self.pk_list is not None:
+                    self.logger.debug(f"Comparison() - source table {self.source} has the "
+                                      f"primary key columns {self.pk_list}")
+        if self.pk_list is None:
+            raise RuntimeError("No logical PK can be derived from the source or the comparison table, hence the "
+                               "logical_pk_list must be provided")
+        self.last_execution = OperationalMetadata()
+
+        source_rows = self.source.get_estimated_row_count(duckdb)
+        comparison_rows = self.comparison.get_estimated_row_count(duckdb)
+        comparison_is_smaller = (source_rows is not None and comparison_rows is not None
+                                 and comparison_rows < source_rows)
+
+        ddl, delta_sql = self._compile(duckdb, comparison_is_smaller)
         output_table_str = quote_str(self.table_name)
-        sql = f"CREATE OR REPLACE TABLE {output_table_str} AS FROM {self.comparison.get_sub_select_clause()} with no data"
-        self.logger.debug(f"Comparison() - Create output table {output_table_str} via the sql statement <{sql}>")
-        duckdb.execute(sql)
-        if not comparison_table_has_change_type:
-            sql = f"ALTER TABLE {output_table_str} add {CHANGE_TYPE_COLUMN} varchar(1)"
-            self.logger.debug(f"Comparison() - Adding the change_type column to the output table <{sql}>")
+        for sql in ddl:
+            self.logger.debug(f"Comparison() - Prepare the output table {output_table_str} via the sql statement <{sql}>")
             duckdb.execute(sql)
-        output_list = input_fields_str_s.replace('s.', "") + additional_fields_str_t.replace('t.',
-                                             "") + f", {CHANGE_TYPE_COLUMN}"
-        sql = f"insert into {output_table_str}({output_list}) {select}"
         self.logger.debug(f"Comparison() - Executing the SQL statement to identify the delta and "
-                          f"split into insert and update records via the sql statement <{sql}>")
+                          f"split into insert and update records via the sql statement <{delta_sql}>")
         if self.end_date_column is not None:
-            duckdb.execute(sql, [self.termination_date])
+            duckdb.execute(delta_sql, [self.termination_date])
         else:
-            duckdb.execute(sql)
-        res = duckdb.execute(f"select count(*) from {output_table_str}").fetchall()
-        self.last_execution.processed(res[0][0])
+            duckdb.execute(delta_sql)
+        res = duckdb.execute(f"select count(*) from {output_table_str}").fetchone()
+        if self.analyze_after:
+            duckdb.execute(f"ANALYZE {output_table_str}")
+        self.last_execution.processed(res[0])
         self.logger.info(f"Comparison() - {self.last_execution}")
 
 class SCD2(TableSynonym):
@@ -218,7 +291,7 @@ class SCD2(TableSynonym):
                  termination_date: Union[None, datetime] = None,
                  current_flag_column: Union[None, str] = None,
                  current_flag_set: Union[None, str] = None, current_flag_unset: Union[None, str] = None,
-                 logger: Union[None, Logger] = None):
+                 logger: Union[None, Logger] = None, analyze_after: bool = True):
         """
         The SCD2 transform takes the information created by the Comparison and turns that into the changes
         required for the target table to contain SCD2 data.
@@ -242,6 +315,7 @@ class SCD2(TableSynonym):
         :param current_flag_set: if the row is the active version, the current flag column should be set to this value - default 'Y'
         :param current_flag_unset: the value for all versions not active - default 'N'
         :param logger: Logger of the dataflow
+        :param analyze_after: refresh the optimizer statistics of the table after it got updated
         """
         if name is None:
             name = f"SCD2 for table {source.table_name}"
@@ -270,6 +344,7 @@ class SCD2(TableSynonym):
         self.current_flag_column = current_flag_column
         self.current_flag_set = current_flag_set
         self.current_flag_unset = current_flag_unset
+        self.analyze_after = analyze_after
 
     def add_default_columns(self, table: Table):
         table.add_column(pa.field(self.start_date_column, pa.timestamp('ms')))
@@ -341,8 +416,10 @@ class SCD2(TableSynonym):
         self.logger.debug(f"SCD2() - Converting the CDC info of table {source_table} into SCD2 info: <{sql}>")
         duckdb.execute(sql, [start_date, end_date, self.termination_date,
                              self.current_flag_set, self.current_flag_unset])
-        res = duckdb.execute(f"select count(*) from {source_table}").fetchall()
-        self.last_execution.processed(res[0][0])
+        res = duckdb.execute(f"select count(*) from {source_table}").fetchone()
+        if self.analyze_after:
+            duckdb.execute(f"ANALYZE {source_table}")
+        self.last_execution.processed(res[0])
         self.logger.info(f"SCD2() - {self.last_execution}")
 
 class GenerateKey(TableSynonym):
@@ -350,7 +427,7 @@ class GenerateKey(TableSynonym):
     def __init__(self, cdc_table: Table,
                  start_value: Union[int, Table], name: Union[None, str] = None,
                  surrogate_key_column: Union[None, str] = None,
-                 logger: Union[None, Logger] = None):
+                 logger: Union[None, Logger] = None, analyze_after: bool = True):
         """
         GenerateKey() goes through all rows of the cdc table and updates the surrogate key column with new unique
         numbers. For that it must read the max(surrogate key) from the physical target table and use that as the
@@ -365,6 +442,7 @@ class GenerateKey(TableSynonym):
         :param surrogate_key_column: the column name - default is the physical primary key of the target table
         :param start_value: Either a start value or a table from which the max(surrogate key) is read
         :param logger: Logger of the dataflow
+        :param analyze_after: refresh the optimizer statistics of the table after it got updated
         """
         if name is None:
             name = f"GenerateKey({cdc_table.table_name})"
@@ -376,6 +454,7 @@ class GenerateKey(TableSynonym):
             self.logger = logger
         self.surrogate_key_column = surrogate_key_column
         self.start_value = start_value
+        self.analyze_after = analyze_after
 
     def add_default_columns(self, table: Table):
         if self.surrogate_key_column is not None:
@@ -405,8 +484,8 @@ class GenerateKey(TableSynonym):
             self.logger.debug(
                 f"GenerateKey() - No start value provided, reading the max({self.surrogate_key_column}) value "
                 f"from {self.start_value.table_name}: <{sql}>")
-            res = duckdb.execute(sql).fetchall()
-            start_value = res[0][0]
+            res = duckdb.execute(sql).fetchone()
+            start_value = res[0]
             if start_value is None:
                 start_value = 1
             else:
@@ -421,8 +500,10 @@ class GenerateKey(TableSynonym):
         self.logger.debug(f"GenerateKey() - Updating the key for all insert rows: <{sql}>")
         duckdb.execute(sql)
         res = duckdb.execute(f"select count(*) from {quote_str(self.table_name)} "
-                             f"where {CHANGE_TYPE_COLUMN} = '{RowType.INSERT.value}'").fetchall()
-        self.last_execution.processed(res[0][0])
+                             f"where {CHANGE_TYPE_COLUMN} = '{RowType.INSERT.value}'").fetchone()
+        if self.analyze_after:
+            duckdb.execute(f"ANALYZE {quote_str(self.table_name)}")
+        self.last_execution.processed(res[0])
         self.logger.info(f"GenerateKey() - {self.last_execution}")
 
 
@@ -468,24 +549,18 @@ class CDCOperation(TableSynonym):
     def execute(self, duckdb):
         self.logger.info(f"CDCOperation() - Started for {self.name}")
         self.last_execution = OperationalMetadata()
-        mapping_str = ""
         mappings = {
             '{RowType.INSERT.value}': self.map_insert_to,
             '{RowType.UPDATE.value}': self.map_update_to,
             '{RowType.BEFORE.value}': self.map_before_to,
             '{RowType.DELETE.value}': self.map_delete_to
         }
-        for key, value in mappings.items():
-            if value is not None:
-                if len(mapping_str) > 0:
-                    mapping_str += ", "
-                mapping_str += f"when {CHANGE_TYPE_COLUMN} = '{key}' then '{value}'"
+        mapping_str = ", ".join([f"when {CHANGE_TYPE_COLUMN} = '{key}' then '{value}'"
+                                 for key, value in mappings.items() if value is not None])
         expression_str = ""
         if self.column_expressions is not None:
-            for key, value in self.column_expressions.items():
-                if len(expression_str) > 0:
-                    expression_str += ", "
-                expression_str += f"set {quote_str(key)} = {value}"
+            expression_str = ", ".join([f"set {quote_str(key)} = {value}"
+                                        for key, value in self.column_expressions.items()])
 
         sql = f"""
             update {quote_str(self.table_name)}
@@ -508,6 +583,6 @@ class CDCOperation(TableSynonym):
             """
         duckdb.execute(sql)
         self.logger.debug(f"CDCOperation() - Updating the table with: <{sql}>")
-        res = duckdb.execute(f"select count(*) from {quote_str(self.table_name)}").fetchall()
-        self.last_execution.processed(res[0][0])
+        res = duckdb.execute(f"select count(*) from {quote_str(self.table_name)}").fetchone()
+        self.last_execution.processed(res[0])
         self.logger.info(f"CDCOperation() - {self.last_execution}")
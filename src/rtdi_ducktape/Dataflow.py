@@ -7,8 +7,13 @@ from rtdi_ducktape.Metadata import Step, OperationalMetadata, Table
 
 class Dataflow:
 
-    def __init__(self, logger: Union[None, Logger] = None):
+    def __init__(self, logger: Union[None, Logger] = None, max_workers: int = 1):
+        """
+        :param logger: logger to use
+        :param max_workers: number of independent steps executed concurrently
+        """
         self.nodes = []
+        self.max_workers = max_workers
         if logger is None:
             self.logger = logging.getLogger("Dataflow")
         else:
@@ -19,10 +24,20 @@ class Dataflow:
         self.nodes.append(step)
         return step
 
+    def topological_order(self) -> list[Step]:
+        """
+        The steps of the dataflow in the order they are executed, each step after all its inputs.
+
+        :raises RuntimeError: if the steps form a cycle
+        """
+        if len(self.nodes) == 0:
+            return []
+        return self.nodes[0].get_topological_order()
+
     def start(self, duckdb):
         if len(self.nodes) > 0:
             self.last_execution = OperationalMetadata()
-            self.nodes[0].start(duckdb)
+            self.nodes[0].start(duckdb, self.max_workers)
             rows_loaded = 0
             for node in self.nodes:
                 if isinstance(node, Table) and node.last_execution is not None:
@@ -4,11 +4,12 @@ from typing import Union, Iterable
 
 from deltalake import DeltaTable, write_deltalake
 import pyarrow as pa
+import pyarrow.compute as pc
 
 from rtdi_ducktape.CDCTransforms import CHANGE_TYPE_COLUMN
 from rtdi_ducktape.Loaders import Loader
-from rtdi_ducktape.Metadata import Dataset, Table, create_join_condition
-from rtdi_ducktape.SQLUtils import convert_list_to_str, quote_str
+from rtdi_ducktape.Metadata import Dataset, Table
+from rtdi_ducktape.SQLUtils import convert_list_to_str, quote_str, quote_literal
 
 
 class DeltaLakeTable(Loader):
@@ -16,13 +17,35 @@ class DeltaLakeTable(Loader):
     def __init__(self, root_url: str, source: Dataset, table_name: str, name: Union[None, str] = None,
                  pk_list: Union[None, Iterable[str]] = None, allow_evolution: bool = False,
                  is_cdc: bool = False, generated_key_column: Union[None, str] = None, start_value: Union[None, int] = None,
-                 logger: Union[None, Logger] = None):
+                 logger: Union[None, Logger] = None,
+                 partition_cols: Union[None, Iterable[str]] = None, batch_rows: int = 65536,
+                 partition_overwrite_threshold: Union[None, float] = None):
+        """
+        Write the data into a Delta Lake table. If the source dataset is a CDC source, the changes are merged,
+        else the rows are upserted via the primary key or appended if there is none.
+
+        :param root_url: the directory or object store url containing the delta tables
+        :param partition_cols: the partition columns of the delta table. The merge is limited to the partitions
+        present in the source data, hence only the files of these partitions are read
+        :param batch_rows: number of rows per Arrow record batch when streaming the source into the delta table.
+        Large enough to amortize the per batch overhead, small enough for the working set to stay in the CPU cache
+        :param partition_overwrite_threshold: optional, only for partitioned tables with a non-CDC source that
+        delivers the complete content of every partition it touches. If the source has at least this fraction of the
+        target rows in these partitions, e.g. 0.5, the partitions are overwritten instead of merged, which is much
+        cheaper than a merge updating most rows. Target rows missing in the source are removed then! Not used with a
+        generated_key_column, as the rewritten rows would get new key values, hence such tables are always merged
+        """
         super().__init__(source, table_name, name, pk_list, allow_evolution,
                          is_cdc, generated_key_column, start_value, logger)
         self.root_url = root_url
+        self.partition_cols = list(partition_cols) if partition_cols is not None else None
+        self.batch_rows = batch_rows
+        self.partition_overwrite_threshold = partition_overwrite_threshold
+        self._dt = None
 
     def execute(self, duckdb):
-        cols = self.source.get_cols(duckdb)
+        # keep the column order of the source so the generated statements are the same for every execution
+        cols = [col for col in self.source.get_schema(duckdb).names if col != self.generated_key_column]
         seq_value_str = ""
         if self.generated_key_column is not None:
             sequence_name = self.table_name + "_seq"
@@ -34,28 +57,53 @@ class DeltaLakeTable(Loader):
                 seq_value_str = f", case when {CHANGE_TYPE_COLUMN} = 'I' then nextval('{sequence_name}') else {gen_column} end as {gen_column}"
             else:
                 seq_value_str = f", coalesce({gen_column}, nextval('{sequence_name}')) as {gen_column}"
-            cols.discard(quote_str(self.generated_key_column))
         cols_str = convert_list_to_str(cols)
         sql = f"""with source as ({self.source.get_sub_select_clause()}) 
                SELECT {cols_str}{seq_value_str} from source
             """
-        data = duckdb.sql(sql).arrow()
-        join_condition = create_join_condition(self.pk_list, 's', 't')
+        if self.pk_list is None:
+            if self.source.is_cdc and not self.is_cdc:
+                raise RuntimeError(f"Applying the changes to {self.table_name} requires a primary key")
+            data = duckdb.sql(sql).to_arrow_reader(self.batch_rows)
+            write_deltalake(f"{self.root_url}/{self.table_name}", data, mode="append",
+                            partition_by=self.partition_cols)
+            return
+
+        join_condition = self.get_join_condition('s', 't')
+        if self.partition_cols is not None:
+            partitions = self.get_source_partitions(duckdb)
+            if self.use_partition_overwrite(partitions):
+                predicate = self.get_partition_overwrite_predicate(partitions)
+                self.logger.debug(f"DeltaLakeTable() - Overwriting the partitions <{predicate}> instead of a merge")
+                data = duckdb.sql(sql).to_arrow_reader(self.batch_rows)
+                write_deltalake(f"{self.root_url}/{self.table_name}", data, mode="overwrite",
+                                predicate=predicate, partition_by=self.partition_cols)
+                return
+            # With the partitions hardcoded in the predicate, delta-rs can merge the source batch by batch
+            join_condition += self.get_partition_predicate(partitions)
+            data = duckdb.sql(sql).to_arrow_reader(self.batch_rows)
+            streamed_exec = True
+        else:
+            # A streamed merge cannot derive an early pruning predicate from the source statistics, so without a
+            # partition predicate it would read every target file. The materialized source keeps that pruning.
+            data = duckdb.sql(sql).to_arrow_table()
+            streamed_exec = False
         self.logger.debug(
             f"DeltaLakeTable() - Join condition for the delta merge is <{join_condition}>")
 
-
-        update_map = dict()
-        for col in cols:
-            if col not in self.pk_list:
-                update_map[col] = f"s.{col}"
-        insert_map = update_map.copy()
+        pk_set = frozenset(self.pk_list)
+        source_cols = {col: f"s.{quote_str(col)}" for col in cols}
         if self.generated_key_column is not None:
-            insert_map[self.generated_key_column] = f"s.{self.generated_key_column}"
+            source_cols[self.generated_key_column] = f"s.{quote_str(self.generated_key_column)}"
+        # an insert sets all columns, an update all but the primary key and the generated key
+        insert_map = source_cols
+        update_map = {col: value for col, value in source_cols.items()
+                      if col not in pk_set and col != self.generated_key_column}
 
-        dt = DeltaTable(f"{self.root_url}/{self.table_name}")
+        dt = self.get_delta_table()
         if self.source.is_cdc and not self.is_cdc:
-            (dt.merge(source=data, predicate=join_condition, source_alias='s', target_alias='t')
+            (dt.merge(source=data, predicate=join_condition, source_alias='s', target_alias='t',
+                      streamed_exec=streamed_exec)
              .when_matched_delete(predicate="s.__change_type = 'D'")
              .when_matched_update(
                 updates = update_map,
@@ -66,8 +114,9 @@ class DeltaLakeTable(Loader):
                 predicate="s.__change_type = 'I'"
               )
              ).execute()
-        elif self.pk_list is not None:
-            (dt.merge(source=data, predicate=join_condition, source_alias='s', target_alias='t')
+        else:
+            (dt.merge(source=data, predicate=join_condition, source_alias='s', target_alias='t',
+                      streamed_exec=streamed_exec)
              .when_matched_update(
                 updates = update_map
               )
@@ -75,25 +124,123 @@ class DeltaLakeTable(Loader):
                 updates = insert_map
               )
              ).execute()
-        else:
-            write_deltalake(f"{self.root_url}/{self.table_name}", data, mode="append")
+
+    def get_source_partitions(self, duckdb) -> pa.Table:
+        """
+        The distinct partition values of the source data with the number of source rows in the column __rows
+        """
+        partition_cols_str = convert_list_to_str(self.partition_cols)
+        sql = f"""with source as ({self.source.get_sub_select_clause()})
+               SELECT {partition_cols_str}, count(*) as "__rows" from source group by all
+            """
+        return duckdb.sql(sql).to_arrow_table()
+
+    def get_partition_predicate(self, partitions: pa.Table) -> str:
+        """
+        Restrict the merge to the partitions present in the source data by adding the partition values as
+        hardcoded in-list for the target side
+        """
+        predicate = ""
+        for col in self.partition_cols:
+            values = pc.unique(partitions.column(col)).to_pylist()
+            if len(values) == 0:
+                # no source rows, no partition is touched
+                return " and false"
+            conditions = []
+            values_str = ", ".join([quote_literal(v) for v in values if v is not None])
+            if len(values_str) > 0:
+                conditions.append(f"t.{quote_str(col)} in ({values_str})")
+            if None in values:
+                conditions.append(f"t.{quote_str(col)} is null")
+            predicate += f" and ({' or '.join(conditions)})"
+        return predicate
+
+    def use_partition_overwrite(self, partitions: pa.Table) -> bool:
+        if (self.partition_overwrite_threshold is None or self.source.is_cdc or partitions.num_rows == 0
+                or self.generated_key_column is not None):
+            # an overwrite would assign new generated keys to existing rows, only the merge keeps them
+            return False
+        touched = {tuple(row.values()) for row in partitions.select(self.partition_cols).to_pylist()}
+        actions = pa.table(self.get_delta_table().get_add_actions(flatten=True))
+        partition_columns = [f"partition.{col}" for col in self.partition_cols]
+        target_rows = 0
+        for action in actions.select(partition_columns + ["num_records"]).to_pylist():
+            if tuple(action[col] for col in partition_columns) in touched:
+                target_rows += action["num_records"] or 0
+        source_rows = pc.sum(partitions.column("__rows")).as_py()
+        self.logger.debug(f"DeltaLakeTable() - The source has {source_rows} rows for partitions containing "
+                          f"{target_rows} rows in the target")
+        return target_rows == 0 or source_rows / target_rows >= self.partition_overwrite_threshold
+
+    def get_partition_overwrite_predicate(self, partitions: pa.Table) -> str:
+        """
+        The exact partition value combinations of the source, unlike the per column in-lists of the merge
+        predicate, which could include partitions the source has no data for
+        """
+        conditions = []
+        for row in partitions.select(self.partition_cols).to_pylist():
+            values = [f"{quote_str(col)} is null" if value is None else f"{quote_str(col)} = {quote_literal(value)}"
+                      for col, value in row.items()]
+            conditions.append(f"({' and '.join(values)})")
+        return " or ".join(conditions)
 
     def get_generated_key_start(self, duckdb):
         if self.start_value is not None:
             return self.start_value
         elif self.generated_key_column is not None:
-            sql = f"select max({quote_str(self.generated_key_column)}) from delta_scan('{self.root_url}/{self.table_name}')"
-            self.logger.debug(
-                f"DeltaLakeTable() - No start value provided, reading the max({self.generated_key_column}) value "
-                f"from {self.root_url}/{self.table_name}: <{sql}>")
-            res = duckdb.execute(sql).fetchall()
-            start_value = res[0][0]
+            found, start_value = self.get_max_from_statistics(self.generated_key_column)
+            if not found:
+                sql = (f"select max({quote_str(self.generated_key_column)}) "
+                       f"from delta_scan('{self.root_url}/{self.table_name}')")
+                self.logger.debug(
+                    f"DeltaLakeTable() - No start value provided and no file statistics available, reading the "
+                    f"max({self.generated_key_column}) value from {self.root_url}/{self.table_name}: <{sql}>")
+                res = duckdb.execute(sql).fetchone()
+                start_value = res[0]
             if start_value is None:
                 start_value = 1
             else:
                 start_value += 1
             return start_value
 
+    def get_max_from_statistics(self, column: str) -> tuple[bool, any]:
+        """
+        Read the max value of a column from the per file statistics in the delta log instead of scanning the data.
+
+        :return: a flag if the statistics are complete and the max value, which is None for an empty table
+        """
+        dt = self.get_delta_table()
+        actions = pa.table(dt.get_add_actions(flatten=True))
+        if actions.num_rows == 0:
+            return True, None
+        if f"max.{column}" not in actions.column_names or f"null_count.{column}" not in actions.column_names:
+            return False, None
+        max_values = actions.column(f"max.{column}")
+        null_counts = actions.column(f"null_count.{column}")
+        num_records = actions.column("num_records")
+        # files written without statistics have no record or null count
+        if pc.any(pc.or_(pc.is_null(null_counts), pc.is_null(num_records))).as_py():
+            return False, None
+        # a file with non-null values but without a max value has no statistics either
+        has_values = pc.less(null_counts, num_records)
+        if pc.any(pc.and_(has_values, pc.is_null(max_values))).as_py():
+            return False, None
+        max_value = pc.max(max_values).as_py()
+        self.logger.debug(f"DeltaLakeTable() - max({column}) from the delta log file statistics is {max_value}")
+        return True, max_value
+
+    def get_delta_table(self) -> DeltaTable:
+        """
+        The DeltaTable handle is kept across executions, for repeated loads only the new delta log entries are read.
+        """
+        if self._dt is None:
+            self._dt = DeltaTable(f"{self.root_url}/{self.table_name}")
+        else:
+            self._dt.update_incremental()
+        return self._dt
+
     def create_table(self, duckdb):
         table = self.schema.empty_table()
-        write_deltalake(f"{self.root_url}/{self.table_name}", table, mode="overwrite")
+        write_deltalake(f"{self.root_url}/{self.table_name}", table, mode="overwrite",
+                        partition_by=self.partition_cols)
+        self._dt = None
@@ -1,12 +1,17 @@
 import logging
+import re
 from logging import Logger
 from typing import Union, Iterable
 
 from .CDCTransforms import CHANGE_TYPE
-from .Metadata import Dataset, Table, OperationalMetadata, create_join_condition
-from .SQLUtils import convert_list_to_str, quote_str
+from .Metadata import Dataset, Table, OperationalMetadata
+from .SQLUtils import convert_list_to_str, quote_str, get_first
+from duckdb import __version__ as duckdb_version
 import pyarrow as pa
 
+# MERGE INTO is supported since DuckDB 1.4
+MERGE_SUPPORTED = tuple(int(v) for v in re.match(r"(\d+)\.(\d+)", duckdb_version).groups()) >= (1, 4)
+
 
 class Loader(Table):
 
@@ -79,8 +84,8 @@ class DuckDBTable(Loader):
             self.logger.debug(
                 f"DuckDBTable() - No start value provided, reading the max({self.generated_key_column}) value "
                 f"from {self.table_name}: <{sql}>")
-            res = duckdb.execute(sql).fetchall()
-            start_value = res[0][0]
+            res = duckdb.execute(sql).fetchone()
+            start_value = res[0]
             if start_value is None:
                 start_value = 1
             else:
@@ -91,7 +96,7 @@ class DuckDBTable(Loader):
         self.last_execution = OperationalMetadata()
         target_table = self.table_name
         target_table_name = quote_str(target_table)
-        table_pk_list = self.get_table_primary_key(duckdb)
+        table_pk_list = self.get_physical_primary_key(duckdb)
         if self.pk_list is None:
             self.logger.debug(f"DuckDBTable() - No logical primary key provided, reading the pk "
                               f"of the target table {target_table}...")
@@ -104,116 +109,138 @@ class DuckDBTable(Loader):
                 self.logger.debug(f"DuckDBTable() - Target table {target_table} has the primary "
                                   f"key columns {self.pk_list}")
                 use_table_pk = True
-        elif self.pk_list == table_pk_list:
+        elif table_pk_list is not None and set(self.pk_list) == table_pk_list:
             use_table_pk = True
         else:
             use_table_pk = False
 
-        cols = set(self.source.get_cols(duckdb))
-        if CHANGE_TYPE not in self.get_cols(duckdb):
-            cols.discard(CHANGE_TYPE)
+        # keep the column order of the source so the generated statements are the same for every execution
+        skip = {self.generated_key_column}
+        if not self.has_column(duckdb, CHANGE_TYPE):
+            skip.add(CHANGE_TYPE)
+        cols = [col for col in self.source.get_schema(duckdb).names if col not in skip]
 
         gen_key_str = ""
-        seq_value_str = ""
+        sequence_name = None
         if self.generated_key_column is not None:
             sequence_name = self.table_name + "_seq"
             sql = f"create or replace sequence {quote_str(sequence_name)} start {self.get_generated_key_start(duckdb)}"
             self.logger.debug(f"DuckDBTable() - Creating the sequence for the key: <{sql}>")
             duckdb.execute(sql)
             gen_key_str = ", " + quote_str(self.generated_key_column)
-            seq_value_str = f", nextval('{sequence_name}')"
-            cols.discard(self.generated_key_column)
         cols_str = convert_list_to_str(cols)
 
+        # The source is evaluated once, all statements below read the staged rows
+        source_table = quote_str(f"_src_{id(self)}")
+        sql = f"create or replace temp table {source_table} as {self.source.get_sub_select_clause()}"
+        self.logger.debug(f"DuckDBTable() - Staging the source rows via the SQL <{sql}>")
+        duckdb.execute(sql)
+        try:
+            self.apply_changes(duckdb, source_table, cols, cols_str, gen_key_str, sequence_name, use_table_pk)
+        finally:
+            duckdb.execute(f"drop table if exists {source_table}")
+
+    def apply_changes(self, duckdb, source_table: str, cols: list[str], cols_str: str, gen_key_str: str,
+                      sequence_name: Union[None, str], use_table_pk: bool):
+        target_table_name = quote_str(self.table_name)
+        seq_value_str = ""
+        if sequence_name is not None:
+            seq_value_str = f", nextval('{sequence_name}')"
+        update_set_str = None
+        if self.pk_list is not None:
+            pk_set = frozenset(self.pk_list)
+            quoted = [quote_str(col) for col in cols]
+            update_set_str = ", ".join([f"{q} = s.{q}" for q, col in zip(quoted, cols)
+                                        if col not in pk_set and col != self.generated_key_column])
         if self.source.is_cdc and not self.is_cdc and self.pk_list is not None:
-            update_set_str = ""
-            for col in cols:
-                if col not in self.pk_list and col != self.generated_key_column:
-                    if len(update_set_str) > 0:
-                        update_set_str += ", "
-                    update_set_str += f"{quote_str(col)} = s.{quote_str(col)}"
-            pk_list_str = convert_list_to_str(self.pk_list)
-            join_condition = create_join_condition(self.pk_list, 's', target_table_name)
-            sql = f"""with source as {self.source.get_sub_select_clause()} 
-                   INSERT INTO {target_table_name}({cols_str}{gen_key_str})
-                   SELECT {cols_str}{seq_value_str} from source
-                   where \"__change_type\" = 'I'
-                """
-            self.logger.debug(f"DuckDBTable() - Insert all __change_type='I' rows via the SQL <{sql}>")
-            duckdb.execute(sql)
-            sql = f"""with source as {self.source.get_sub_select_clause()}
-                   UPDATE {target_table_name} set {update_set_str} from source s
-                   where {join_condition} and s.\"__change_type\" = 'U'
-                """
-            self.logger.debug(f"DuckDBTable() - Update all __change_type='U' rows in the target via the SQL <{sql}>")
-            duckdb.execute(sql)
-            sql = f"""with source as {self.source.get_sub_select_clause()}
-                   DELETE FROM {target_table_name}
-                   where {pk_list_str} in (SELECT {pk_list_str} from source where \"__change_type\" = 'D')
+            count_sql = f"select count(*) from {source_table}"
+            insert_values_str = convert_list_to_str(cols, 's')
+            if sequence_name is not None:
+                # the case expression makes sure only inserted rows draw a value from the sequence
+                insert_values_str += f", case when s.\"__change_type\" = 'I' then nextval('{sequence_name}') end"
+            update_clause = ""
+            if len(update_set_str) > 0:
+                update_clause = f"when matched and s.\"__change_type\" = 'U' then update set {update_set_str}"
+            # insert rows never match, as with a plain insert they are added even if the key exists already,
+            # e.g. the SCD2 insert rows carry the generated key of the version they replace
+            merge_sql = f"""MERGE INTO {target_table_name} as t using {source_table} as s
+                   on {self.get_join_condition('s', 't')} and s.\"__change_type\" <> 'I'
+                   when matched and s.\"__change_type\" = 'D' then delete
+                   {update_clause}
+                   when not matched and s.\"__change_type\" = 'I' then
+                   insert ({cols_str}{gen_key_str}) values ({insert_values_str})
                 """
-            self.logger.debug(f"DuckDBTable() - Delete all __change_type='D' rows in the target via the SQL <{sql}>")
-            duckdb.execute(sql)
-            res = duckdb.execute(f"""
-                with source as ({self.source.get_sub_select_clause()})
-                select count(*) from source""").fetchall()
-            self.last_execution.processed(res[0][0])
+            if MERGE_SUPPORTED:
+                self.logger.debug(f"DuckDBTable() - Apply all changes in one pass via the SQL <{merge_sql}>")
+                statements = [merge_sql]
+            else:
+                self.logger.debug(f"DuckDBTable() - DuckDB {duckdb_version} does not support MERGE, "
+                                  f"using individual insert, update and delete statements")
+                statements = self.get_change_statements(source_table, cols_str, gen_key_str, seq_value_str,
+                                                        update_set_str)
+            # the result is the one of the last statement, the count
+            res = duckdb.execute(";\n".join(statements + [count_sql])).fetchone()
+            self.last_execution.processed(res[0])
             self.logger.info(f"DuckDBTable() - {self.last_execution}")
         else:
             if use_table_pk:
                 # Upsert using the primary key
-                sql = f"""with source as {self.source.get_sub_select_clause()} 
-                       INSERT OR REPLACE INTO {target_table_name}({cols_str})
-                       SELECT {cols_str} from source
+                sql = f"""INSERT OR REPLACE INTO {target_table_name}({cols_str})
+                       SELECT {cols_str} from {source_table}
                     """
                 self.logger.debug(f"DuckDBTable() - Upsert all rows via the SQL <{sql}>")
-                duckdb.execute(sql)
-                res = duckdb.execute(f"""
-                    with source as ({self.source.get_sub_select_clause()})
-                    select count(*) from source""").fetchall()
-                self.last_execution.processed(res[0][0])
+                # the DML returns the number of affected rows, no need to count the source again
+                res = duckdb.execute(sql).fetchone()
+                self.last_execution.processed(res[0])
                 self.logger.info(f"DuckDBTable() - {self.last_execution}")
             elif self.pk_list is not None:
                 # Upsert using a logical primary key
-                update_set_str = ""
-                for col in cols:
-                    if col not in self.pk_list and col != self.generated_key_column:
-                        if len(update_set_str) > 0:
-                            update_set_str += ", "
-                        update_set_str += f"{col} = s.{col}"
-                pk_list_str = convert_list_to_str(self.pk_list)
-                join_condition = create_join_condition(self.pk_list, 's', target_table_name)
-
-                sql = f"""with source as {self.source.get_sub_select_clause()}
-                       UPDATE {target_table_name} set {update_set_str} from source s
+                join_condition = self.get_join_condition('s', target_table_name)
+
+                sql = f"""UPDATE {target_table_name} set {update_set_str} from {source_table} s
                        where {join_condition}
                     """
                 self.logger.debug(f"DuckDBTable() - Updated all matching existing rows via the SQL <{sql}>")
-                duckdb.execute(sql)
+                updated = duckdb.execute(sql).fetchone()[0]
 
-                sql = f"""with source as {self.source.get_sub_select_clause()} 
-                       INSERT INTO {target_table_name}({cols_str})
-                       SELECT {cols_str} from source 
-                       where {pk_list_str} not in (select {pk_list_str} from {target_table_name})
+                # anti join, rows of the source without a matching target row
+                sql = f"""INSERT INTO {target_table_name}({cols_str})
+                       SELECT {convert_list_to_str(cols, 's')} from {source_table} s
+                       left join {target_table_name} on {join_condition}
+                       where {target_table_name}.{quote_str(get_first(self.pk_list))} is null
                     """
                 self.logger.debug(f"DuckDBTable() - Inserted all new rows via the SQL <{sql}>")
-                duckdb.execute(sql)
-
-                res = duckdb.execute(f"""
-                    with source as ({self.source.get_sub_select_clause()})
-                    select count(*) from source""").fetchall()
-                self.last_execution.processed(res[0][0])
+                inserted = duckdb.execute(sql).fetchone()[0]
+                self.last_execution.processed(updated + inserted)
                 self.logger.info(f"DuckDBTable() - {self.last_execution}")
             else:
-                sql = f"""with source as {self.source.get_sub_select_clause()} 
-                       INSERT INTO {target_table_name}({cols_str}{gen_key_str})
-                       SELECT {cols_str}{seq_value_str} from source
+                sql = f"""INSERT INTO {target_table_name}({cols_str}{gen_key_str})
+                       SELECT {cols_str}{seq_value_str} from {source_table}
                     """
                 self.logger.debug(f"DuckDBTable() - Insert all rows via the SQL <{sql}>")
-                duckdb.execute(sql)
-                res = duckdb.execute(f"""
-                    with source as {self.source.get_sub_select_clause()}
-                    select count(*) from source""").fetchall()
-                self.last_execution.processed(res[0][0])
+                res = duckdb.execute(sql).fetchone()
+                self.last_execution.processed(res[0])
                 self.logger.info(f"DuckDBTable() - {self.last_execution}")
 
-
+    def get_change_statements(self, source_table: str, cols_str: str, gen_key_str: str, seq_value_str: str,
+                              update_set_str: str) -> list[str]:
+        """
+        The insert, update and delete statements applying the changes, for DuckDB versions without MERGE support
+        """
+        target_table_name = quote_str(self.table_name)
+        pk_list_str = convert_list_to_str(self.pk_list)
+        join_condition = self.get_join_condition('s', target_table_name)
+        insert_sql = f"""INSERT INTO {target_table_name}({cols_str}{gen_key_str})
+               SELECT {cols_str}{seq_value_str} from {source_table}
+               where \"__change_type\" = 'I'
+            """
+        self.logger.debug(f"DuckDBTable() - Insert all __change_type='I' rows via the SQL <{insert_sql}>")
+        update_sql = f"""UPDATE {target_table_name} set {update_set_str} from {source_table} s
+               where {join_condition} and s.\"__change_type\" = 'U'
+            """
+        self.logger.debug(f"DuckDBTable() - Update all __change_type='U' rows in the target via the SQL <{update_sql}>")
+        delete_sql = f"""DELETE FROM {target_table_name}
+               where {pk_list_str} in (SELECT {pk_list_str} from {source_table} where \"__change_type\" = 'D')
+            """
+        self.logger.debug(f"DuckDBTable() - Delete all __change_type='D' rows in the target via the SQL <{delete_sql}>")
+        return [insert_sql, update_sql, delete_sql]
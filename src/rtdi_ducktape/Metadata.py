@@ -1,6 +1,12 @@
 import datetime
+import heapq
+import queue
 import re
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import timezone
 from enum import Enum, auto
 from logging import Logger
@@ -8,22 +14,37 @@ from typing import Union, Iterable
 
 import pyarrow as pa
 
-from .SQLUtils import quote_str, convert_list_to_str
+from .SQLUtils import quote_str, convert_list_to_str, arrow_to_duckdb_type
+
+# the {dataset_name} placeholders in the sql text of a Query. Dataset names can contain any character, only quotes
+# and colons are excluded so struct literals like {'a': 1} are not taken as placeholders
+_PARAM_RE = re.compile(r"\{([^{}'\":]+)\}")
 
 
 class OperationalMetadata:
 
     def __init__(self):
         self.rows_processed: int = 0
-        self.start_time: datetime = datetime.datetime.now(timezone.utc)
-        self.end_time: datetime = None
-        self.execution_time: int = 0
+        # the duration is measured with the monotonic clock, the wall clock times are converted only when needed
+        self._start_ns = time.perf_counter_ns()
+        self._start_timestamp = time.time()
+        self._end_timestamp: Union[None, float] = None
+        self.execution_time: float = 0
+
+    @property
+    def start_time(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self._start_timestamp, timezone.utc)
+
+    @property
+    def end_time(self) -> Union[None, datetime.datetime]:
+        if self._end_timestamp is None:
+            return None
+        return datetime.datetime.fromtimestamp(self._end_timestamp, timezone.utc)
 
     def processed(self, rows_processed: int):
         self.rows_processed = rows_processed
-        self.end_time = datetime.datetime.now(timezone.utc)
-        delta = self.end_time - self.start_time
-        self.execution_time = delta.total_seconds()
+        self._end_timestamp = time.time()
+        self.execution_time = (time.perf_counter_ns() - self._start_ns) / 1e9
 
     def __str__(self):
         throughput = 0
@@ -46,52 +67,157 @@ class Step(ABC):
         self.last_execution: Union[None, OperationalMetadata] = None
 
     def add_input(self, step: "Step"):
+        """
+        Connect the step as input of this step, the step gets this step as output.
+        """
         if self.inputs is None:
-            self.inputs = {step}
-            step.add_output(self)
-        elif step in self.inputs:
-            return
-        else:
-            self.inputs.add(step)
-            step.add_output(self)
+            self.inputs = set()
+        self.inputs.add(step)
+        if step.outputs is None:
+            step.outputs = set()
+        step.outputs.add(self)
 
     def add_output(self, step: "Step"):
-        if self.outputs is None:
-            self.outputs = {step}
-            step.add_input(self)
-        elif step in self.outputs:
-            return
-        else:
-            self.outputs.add(step)
-            step.add_input(self)
+        step.add_input(self)
 
-    def start(self, duckdb):
+    def get_connected_steps(self) -> list["Step"]:
+        """
+        All steps reachable from this step via inputs and outputs, including this step itself.
+        """
+        steps = [self]
+        visited = {self}
+        pending = deque(steps)
+        while len(pending) > 0:
+            step = pending.popleft()
+            for neighbour in (*(step.inputs or ()), *(step.outputs or ())):
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    steps.append(neighbour)
+                    pending.append(neighbour)
+        return steps
+
+    def get_topological_order(self) -> list["Step"]:
+        """
+        All connected steps in execution order, each step after all its inputs (Kahn's algorithm). Of the steps
+        ready at the same time, the ones with the most outputs come first, as they unblock the most successors,
+        and the remaining ties are ordered by the step name.
+
+        :raises RuntimeError: if the steps form a cycle
+        """
+        steps = self.get_connected_steps()
+        remaining_inputs = {step: len(step.inputs) if step.inputs is not None else 0 for step in steps}
+        position = {step: i for i, step in enumerate(steps)}
+        ready = []
+        order = []
+        self.add_ready(ready, [step for step in steps if remaining_inputs[step] == 0], position)
+        while len(ready) > 0:
+            step = heapq.heappop(ready)[-1]
+            order.append(step)
+            self.add_ready(ready, step.release_outputs(remaining_inputs), position)
+        if len(order) < len(steps):
+            cycle = [str(step) for step in steps if remaining_inputs[step] > 0]
+            raise RuntimeError(f"The dataflow contains a cycle, the steps {cycle} cannot be executed")
+        return order
+
+    @staticmethod
+    def add_ready(ready: list, ready_steps: Iterable["Step"], position: dict["Step", int]):
+        """
+        Push the steps into the heap of ready steps. The step name is the tie-breaker, so the order is the same in
+        every process, unlike the position which follows the iteration order of the input and output sets. The
+        position only separates steps with the same name, so steps are never compared.
+        """
+        for ready_step in ready_steps:
+            out_degree = len(ready_step.outputs) if ready_step.outputs is not None else 0
+            heapq.heappush(ready, (-out_degree, ready_step.name, position[ready_step], ready_step))
+
+    def start(self, duckdb, max_workers: int = 1):
+        """
+        Execute all connected steps, each step after all its inputs. The steps are processed in topological
+        order (Kahn's algorithm) without recursion, so the depth of the graph is not limited by the stack.
+
+        :param duckdb: the connection to execute the steps with
+        :param max_workers: with more than one worker, independent steps are executed concurrently in a thread pool,
+        each using its own cursor of the connection. Steps writing into the same table are never executed at the
+        same time. The lazily filled caches other steps read from, the schema, columns, physical primary key and sub
+        select of a dataset, are filled under the dataset's lock. The join conditions and the compiled Comparison
+        statements are only ever filled with identical values or by the step's own execution.
+        """
+        # a cycle is reported before any step is executed
+        order = self.get_topological_order()
+        if max_workers <= 1:
+            for step in order:
+                step.execute_once(duckdb)
+            return
+        remaining_inputs = {step: len(step.inputs) if step.inputs is not None else 0 for step in order}
+        position = {step: i for i, step in enumerate(order)}
+        ready = []
+        self.add_ready(ready, [step for step in order if remaining_inputs[step] == 0], position)
+        table_locks = {step.table_name: threading.Lock() for step in order if isinstance(step, Table)}
+        # one cursor per worker, created once and reused by all steps instead of a new cursor for every step
+        cursors = queue.Queue()
+        for _ in range(max_workers):
+            cursors.put(duckdb.cursor())
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                # Only as many steps as there are workers are submitted, the others wait in the priority queue
+                # instead of the FIFO queue of the pool. The counters are updated by this thread only.
+                in_flight = dict()
+                while len(ready) > 0 or len(in_flight) > 0:
+                    while len(ready) > 0 and len(in_flight) < max_workers:
+                        step = heapq.heappop(ready)[-1]
+                        in_flight[pool.submit(step.execute_in_cursor, cursors, table_locks)] = step
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        step = in_flight.pop(future)
+                        future.result()
+                        self.add_ready(ready, step.release_outputs(remaining_inputs), position)
+        finally:
+            while not cursors.empty():
+                cursors.get().close()
+
+    def execute_once(self, duckdb):
         self.execute_lock = True
         if not self.executed:
-            if self.inputs is not None:
-                for step in self.inputs:
-                    if not step.executed and not step.execute_lock:
-                        step.start(duckdb)
             self.execute(duckdb)
             self.executed = True
-        if self.outputs is not None:
-            for step in self.outputs:
-                if not step.executed and not step.execute_lock:
-                    step.start(duckdb)
 
+    def execute_in_cursor(self, cursors: queue.Queue, table_locks: dict[str, threading.Lock]):
+        """
+        A DuckDB connection must not be used by multiple threads at the same time, a cursor is a separate
+        connection to the same database. The step borrows one of the pooled cursors and returns it afterwards.
+        """
+        cursor = cursors.get()
+        try:
+            lock = table_locks.get(self.table_name) if isinstance(self, Table) else None
+            if lock is not None:
+                with lock:
+                    self.execute_once(cursor)
+            else:
+                self.execute_once(cursor)
+        finally:
+            cursors.put(cursor)
+
+    def release_outputs(self, remaining_inputs: dict["Step", int]) -> list["Step"]:
+        """
+        Mark this step's outputs as having one input less to wait for.
 
-    def completed(self):
-        if self.executed:
-            if self.inputs is not None:
-                for step in self.inputs:
-                    if step.executed:
-                        step.completed()
-        self.executed = False
-        self.execute_lock = False
+        :return: the outputs with all inputs executed
+        """
+        released = []
         if self.outputs is not None:
-            for step in self.outputs:
-                if step.executed:
-                    step.completed()
+            for output in self.outputs:
+                remaining_inputs[output] -= 1
+                if remaining_inputs[output] == 0:
+                    released.append(output)
+        return released
+
+    def completed(self):
+        """
+        Reset the execution state of all connected steps, so the next start executes them again.
+        """
+        for step in self.get_connected_steps():
+            step.executed = False
+            step.execute_lock = False
 
     @abstractmethod
     def execute(self, duckdb):
@@ -106,12 +232,57 @@ class Dataset(Step, ABC):
     def __init__(self, dataset_name: str, is_cdc: bool = False,
                  pk_list: Union[None, Iterable[str]] = None):
         super().__init__(dataset_name)
+        # guards the lazily filled caches, with parallel execution multiple steps may read this dataset at once
+        self._cache_lock = threading.RLock()
         self.show_projection = "*"
         self.where_clause = None
+        self.where_params = None
         self.pk_list = pk_list
         self.is_cdc = is_cdc
+        self._pending_fields: list[pa.Field] = []
         self.schema: Union[None, pa.Schema] = None
 
+    @property
+    def pk_list(self) -> Union[None, Iterable[str]]:
+        return self._pk_list
+
+    @pk_list.setter
+    def pk_list(self, pk_list: Union[None, Iterable[str]]):
+        self._pk_list = pk_list
+        self._join_conditions: dict[tuple[Union[None, str], Union[None, str]], str] = dict()
+
+    def get_join_condition(self, qualifier_left: Union[None, str], qualifier_right: Union[None, str]) -> str:
+        """
+        The equi join condition on the primary key columns, built once per qualifier pair until the pk_list changes
+        """
+        key = (qualifier_left, qualifier_right)
+        condition = self._join_conditions.get(key)
+        if condition is None:
+            condition = create_join_condition(self.pk_list, qualifier_left, qualifier_right)
+            self._join_conditions[key] = condition
+        return condition
+
+    @property
+    def schema(self) -> Union[None, pa.Schema]:
+        # An Arrow schema is immutable, every append copies all fields. Hence the added columns are collected and
+        # the schema is built once when it is used.
+        if len(self._pending_fields) > 0:
+            with self._cache_lock:
+                if len(self._pending_fields) > 0:
+                    if self._schema is None:
+                        self._schema = pa.schema(self._pending_fields)
+                    else:
+                        self._schema = pa.schema([*self._schema, *self._pending_fields], self._schema.metadata)
+                    self._pending_fields = []
+                    self._cols = None
+        return self._schema
+
+    @schema.setter
+    def schema(self, schema: Union[None, pa.Schema]):
+        self._schema = schema
+        self._pending_fields = []
+        self._cols = None
+
     @abstractmethod
     def is_persisted(self) -> bool:
         pass
@@ -121,57 +292,74 @@ class Dataset(Step, ABC):
         pass
 
     def create_schema(self, db):
+        # only the schema is needed, with limit 0 the source query is planned but no rows are produced
         sql = f"""
             with source as {self.get_sub_select_clause()}
-            select * from source;
+            select * from source limit 0;
         """
         data = db.sql(sql).arrow()
         self.schema = data.schema
 
     def get_schema(self, duckdb):
         if self.schema is None:
-            self.create_schema(duckdb)
+            with self._cache_lock:
+                if self.schema is None:
+                    self.create_schema(duckdb)
         return self.schema
 
-    def get_cols(self, db) -> set[str]:
-        if self.schema is None:
-            self.create_schema(db)
-        return set(self.schema.names)
+    def get_cols(self, db) -> frozenset[str]:
+        # reading the schema first adds pending columns, which resets the cached names
+        self.get_schema(db)
+        if self._cols is None:
+            with self._cache_lock:
+                if self._cols is None:
+                    self._cols = frozenset(self.schema.names)
+        return self._cols
+
+    def has_column(self, db, name: str) -> bool:
+        return name in self.get_cols(db)
+
+    def get_estimated_row_count(self, db) -> Union[None, int]:
+        """
+        Cheap row count estimate without scanning the data, None if unknown
+        """
+        return None
 
     def add_column(self, field: pa.Field):
-        if self.schema is None:
-            self.schema = pa.schema([field], None)
-        else:
-            self.schema = self.schema.append(field)
+        self._pending_fields.append(field)
 
     def set_show_columns(self, projection: list[str]):
         self.show_projection = convert_list_to_str(projection)
 
-    def set_show_where_clause(self, clause):
+    def set_show_where_clause(self, clause, params: Union[None, Iterable[any]] = None):
+        """
+        :param clause: the where clause of the show methods, can contain ? placeholders
+        :param params: the values for the ? placeholders, passed as parameters instead of literals in the SQL text
+        """
         self.where_clause = clause
+        self.where_params = list(params) if params is not None else None
 
-    def show(self, duckdb, logger: Logger, heading: Union[None, str] = None):
+    def get_show_sql(self) -> str:
         where = ""
         if self.where_clause is not None:
             where = " where " + self.where_clause
-        sql = f"""
-        with tab as {self.get_sub_select_clause()}
-        select {self.show_projection} from tab {where}
-        """
+        return f"select {self.show_projection} from {self.get_sub_select_clause()} as tab{where}"
+
+    def show(self, duckdb, logger: Logger, heading: Union[None, str] = None):
+        sql = self.get_show_sql()
         if heading is not None:
             print(heading)
         print(f"Query executed: {self.get_sub_select_clause()}")
-        duckdb.sql(sql).show(max_width=200)
+        duckdb.sql(sql, params=self.where_params).show(max_width=200)
 
     def get_show_data(self, duckdb):
-        where = ""
-        if self.where_clause is not None:
-            where = " where " + self.where_clause
-        sql = f"""
-        with tab as {self.get_sub_select_clause()}
-        select {self.show_projection} from tab {where}
+        return duckdb.sql(self.get_show_sql(), params=self.where_params).fetchall()
+
+    def get_show_data_arrow(self, duckdb) -> pa.Table:
+        """
+        Same as get_show_data but as Arrow table, which does not create a Python object per value
         """
-        return duckdb.execute(sql).fetchall()
+        return duckdb.sql(self.get_show_sql(), params=self.where_params).to_arrow_table()
 
     def execute(self, duckdb):
         pass
@@ -183,6 +371,8 @@ class Table(Dataset):
                  pk_list: Union[None, Iterable[str]] = None, allow_evolution: bool = False):
         super().__init__(dataset_name, is_cdc, pk_list)
         self.table_name = table_name
+        self.physical_pk_list: Union[None, set[str]] = None
+        self.physical_pk_read = False
 
     def is_persisted(self):
         return True
@@ -193,39 +383,54 @@ class Table(Dataset):
     def add_all_columns(self, source: Dataset, duckdb):
         source_schema = source.get_schema(duckdb)
         if self.schema is None:
-            fields = [source_schema.field(i) for i in range(0, len(source_schema.names))]
-            self.schema = pa.schema(fields, None)
+            self.schema = source_schema.remove_metadata()
         else:
-            self.schema = pa.unify_schemas([source_schema])
+            self.schema = pa.unify_schemas([self.schema, source_schema])
 
     def create_schema(self, db):
-        data = db.table(self.table_name).arrow()
+        data = db.table(self.table_name).limit(0).arrow()
         self.schema = data.schema
 
+    def get_estimated_row_count(self, db) -> Union[None, int]:
+        data = db.sql("SELECT estimated_size FROM duckdb_tables() WHERE table_name = ?",
+                      params=[self.table_name]).fetchone()
+        if data is None:
+            return None
+        return data[0]
+
+    def get_physical_primary_key(self, db) -> Union[None, set[str]]:
+        """
+        The primary key as defined in the database. It is read once and cached until the table is created again.
+        """
+        if not self.physical_pk_read:
+            with self._cache_lock:
+                if not self.physical_pk_read:
+                    data = db.sql("SELECT constraint_column_names FROM duckdb_constraints() "
+                                  "WHERE table_name = ? and constraint_type = 'PRIMARY KEY'",
+                                  params=[self.table_name]).fetchone()
+                    pk_list = None
+                    if data is not None and len(data[0]) > 0:
+                        pk_list = set(data[0])
+                    self.physical_pk_list = pk_list
+                    self.physical_pk_read = True
+        return self.physical_pk_list
+
     def get_table_primary_key(self, db) -> Union[None, set[str]]:
         if self.pk_list is None:
-            db.execute(f"SELECT constraint_column_names FROM duckdb_constraints() "
-                       f"WHERE table_name = '{self.table_name}' and constraint_type = 'PRIMARY KEY'")
-            data = db.fetchall()
-            if data is None or len(data) == 0:
-                return None
-            pk_columns = data[0][0]
-            pk_list = set()
-            for field in pk_columns:
-                pk_list.add(field)
-            if len(pk_list) > 0:
+            pk_list = self.get_physical_primary_key(db)
+            if pk_list is not None:
                 self.pk_list = pk_list
         return self.pk_list
 
     def create_table(self, duckdb):
         if self.schema is None:
             raise RuntimeError("Cannot create a table without columns - use add_column to add some")
-        table = self.schema.empty_table()
-        duckdb.sql(f"DROP TABLE IF EXISTS {quote_str(self.table_name)}")
-        rel = duckdb.from_arrow(table)
-        rel.create(self.table_name)
-        pk_str = convert_list_to_str(self.pk_list)
-        duckdb.execute(f"alter table {quote_str(self.table_name)} add primary key ({pk_str})")
+        columns = [f"{quote_str(field.name)} {arrow_to_duckdb_type(field.type)}" for field in self.schema]
+        if self.pk_list is not None:
+            columns.append(f"primary key ({convert_list_to_str(self.pk_list)})")
+        sql = f"create or replace table {quote_str(self.table_name)} ({', '.join(columns)})"
+        duckdb.execute(sql)
+        self.physical_pk_read = False
 
     def set_pk_list(self, pk_list: Union[None, Iterable[str]] = None):
         self.pk_list = pk_list
@@ -256,56 +461,92 @@ class TableSynonym(Table):
         self.synonym_for.show(duckdb, logger, heading)
 
     def get_show_data(self, duckdb):
-        self.synonym_for.get_show_data(duckdb)
+        return self.synonym_for.get_show_data(duckdb)
+
+    def get_show_data_arrow(self, duckdb) -> pa.Table:
+        return self.synonym_for.get_show_data_arrow(duckdb)
 
     def set_pk_list(self, pk_list: Union[None, Iterable[str]] = None):
         self.synonym_for.set_pk_list(pk_list)
 
-    def get_cols(self, duckdb) -> set[str]:
+    def get_cols(self, duckdb) -> frozenset[str]:
         return self.synonym_for.get_cols(duckdb)
 
     def get_table_primary_key(self, duckdb) -> Union[None, set[str]]:
         return self.synonym_for.get_table_primary_key(duckdb)
 
+    def get_physical_primary_key(self, duckdb) -> Union[None, set[str]]:
+        return self.synonym_for.get_physical_primary_key(duckdb)
+
+    def get_estimated_row_count(self, duckdb) -> Union[None, int]:
+        return self.synonym_for.get_estimated_row_count(duckdb)
+
 class Query(Dataset):
 
     def __init__(self, dataset_name: str, sql: str, inputs: Union[None, list[Dataset]] = None, is_cdc: bool = False,
                  pk_list: Union[None, Iterable[str]] = None):
         super().__init__(dataset_name, is_cdc, pk_list)
         self.sql = sql
+        self._sub_select_clause: Union[None, str] = None
         if inputs is not None:
             for i in inputs:
                 self.add_input(i)
-        regex = r"\{\w*\}"
-        matches = re.finditer(regex, sql, re.MULTILINE)
+        self._params = frozenset(_PARAM_RE.findall(sql))
         if self.inputs is not None:
             keys = {x.name for x in inputs}
-            not_found_keys = []
-            for match in matches:
-                parameter = match.group(0)[1:-1]
-                if parameter not in keys:
-                    keys.discard(parameter)
+            not_found_keys = sorted(self._params - keys)
             if len(not_found_keys) > 0:
                 raise RuntimeError(f"The sql contains the parameters {not_found_keys} which are not found in any "
                                    f"of the input datasets with this dataset name - available dataset names "
                                    f"are {keys}")
         else:
-            first = next(matches, None)
-            if first is not None:
+            if len(self._params) > 0:
                 raise RuntimeError("The sql text contains an input parameter but no input datasets are provided")
 
     def set_inputs(self, inputs: list[Dataset]):
         self.inputs = inputs
+        self.invalidate_sub_select_clause()
+
+    def add_input(self, step: "Step"):
+        super().add_input(step)
+        self.invalidate_sub_select_clause()
+
+    def invalidate_sub_select_clause(self):
+        """
+        Forget the cached sub select of this query and of all queries using it, directly or indirectly.
+        """
+        visited = {self}
+        pending = deque([self])
+        while len(pending) > 0:
+            step = pending.popleft()
+            if isinstance(step, Query):
+                step._sub_select_clause = None
+            if step.outputs is not None:
+                for output in step.outputs:
+                    if output not in visited:
+                        visited.add(output)
+                        pending.append(output)
 
     def is_persisted(self):
         return False
 
     def get_sub_select_clause(self) -> str:
-        sql = self.sql
-        if self.inputs is not None:
-            for i in self.inputs:
-                sql = sql.replace("{" + i.name + "}", i.get_sub_select_clause())
-        return f"({sql})"
+        """
+        The sql text with all input placeholders replaced by the input's sub select. Nested queries would build
+        the same text again for every call, hence it is cached until the inputs change.
+        """
+        if self._sub_select_clause is None:
+            with self._cache_lock:
+                if self._sub_select_clause is None:
+                    if self.inputs is None:
+                        self._sub_select_clause = f"({self.sql})"
+                    else:
+                        lookup = {i.name: i.get_sub_select_clause() for i in self.inputs if i.name in self._params}
+                        # a single pass over the sql text, the inserted sub selects are not scanned for placeholders
+                        # again
+                        sql = _PARAM_RE.sub(lambda m: lookup.get(m.group(1), m.group(0)), self.sql)
+                        self._sub_select_clause = f"({sql})"
+        return self._sub_select_clause
 
 
 class RowType(Enum):
@@ -360,16 +601,10 @@ class RowType(Enum):
 
 
 def create_join_condition(pk_list: Iterable[str], qualifier_left: Union[None,str], qualifier_right: Union[None,str]):
-    condition_str = ""
     l = ""
     if qualifier_left is not None:
         l = qualifier_left + "."
     r = ""
     if qualifier_right is not None:
         r = qualifier_right + "."
-    for pk in pk_list:
-        c = quote_str(pk)
-        if len(condition_str) > 0:
-            condition_str += " and "
-        condition_str += f"{l}{c} = {r}{c}"
-    return condition_str
+    return " and ".join([f"{l}{c} = {r}{c}" for c in map(quote_str, pk_list)])
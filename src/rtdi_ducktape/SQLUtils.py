@@ -1,4 +1,6 @@
-from typing import Iterable, Union
+from typing import Iterable, Sized, Union
+
+import pyarrow as pa
 
 
 def quote_str(name: str) -> Union[None, str]:
@@ -10,6 +12,81 @@ def quote_str(name: str) -> Union[None, str]:
         return '"' + name + '"'
 
 
+def quote_literal(value: any) -> str:
+    """
+    Turns a python value into a SQL literal, e.g. a string into a single quoted string with quotes escaped
+    :param value:
+    :return:
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+_ARROW_TO_DUCKDB_TYPES = {
+    pa.bool_(): "BOOLEAN",
+    pa.int8(): "TINYINT",
+    pa.int16(): "SMALLINT",
+    pa.int32(): "INTEGER",
+    pa.int64(): "BIGINT",
+    pa.uint8(): "UTINYINT",
+    pa.uint16(): "USMALLINT",
+    pa.uint32(): "UINTEGER",
+    pa.uint64(): "UBIGINT",
+    pa.float32(): "FLOAT",
+    pa.float64(): "DOUBLE",
+    pa.string(): "VARCHAR",
+    pa.large_string(): "VARCHAR",
+    pa.binary(): "BLOB",
+    pa.large_binary(): "BLOB",
+    pa.date32(): "DATE",
+    pa.date64(): "DATE",
+    pa.null(): "INTEGER",
+    pa.month_day_nano_interval(): "INTERVAL",
+}
+
+_TIMESTAMP_TYPES = {"s": "TIMESTAMP_S", "ms": "TIMESTAMP_MS", "us": "TIMESTAMP", "ns": "TIMESTAMP_NS"}
+
+
+def arrow_to_duckdb_type(data_type: pa.DataType) -> str:
+    """
+    The DuckDB column type for an Arrow data type, the same type DuckDB uses when importing Arrow data
+    :param data_type:
+    :return:
+    """
+    duckdb_type = _ARROW_TO_DUCKDB_TYPES.get(data_type)
+    if duckdb_type is not None:
+        return duckdb_type
+    if pa.types.is_timestamp(data_type):
+        if data_type.tz is not None:
+            return "TIMESTAMPTZ"
+        return _TIMESTAMP_TYPES[data_type.unit]
+    if pa.types.is_time(data_type):
+        return "TIME_NS" if data_type.unit == "ns" else "TIME"
+    if pa.types.is_duration(data_type):
+        return "INTERVAL"
+    if pa.types.is_decimal128(data_type):
+        return f"DECIMAL({data_type.precision},{data_type.scale})"
+    if pa.types.is_fixed_size_binary(data_type):
+        return "BLOB"
+    if pa.types.is_dictionary(data_type):
+        return arrow_to_duckdb_type(data_type.value_type)
+    if pa.types.is_fixed_size_list(data_type):
+        return f"{arrow_to_duckdb_type(data_type.value_type)}[{data_type.list_size}]"
+    if pa.types.is_map(data_type):
+        return f"MAP({arrow_to_duckdb_type(data_type.key_type)}, {arrow_to_duckdb_type(data_type.item_type)})"
+    if pa.types.is_list(data_type) or pa.types.is_large_list(data_type):
+        return f"{arrow_to_duckdb_type(data_type.value_type)}[]"
+    if pa.types.is_struct(data_type):
+        fields = ", ".join([f"{quote_str(field.name)} {arrow_to_duckdb_type(field.type)}" for field in data_type])
+        return f"STRUCT({fields})"
+    raise RuntimeError(f"The Arrow data type {data_type} has no DuckDB equivalent")
+
+
 def convert_list_to_str(values: Iterable[str], qualifier: str = None) -> Union[None, str]:
     """
     Turns the list of strings into a comma separated single string, optionally with qualifier
@@ -17,39 +94,31 @@ def convert_list_to_str(values: Iterable[str], qualifier: str = None) -> Union[N
     :param qualifier:
     :return:
     """
-    output_str = ""
-    if values is not None:
-        for field in values:
-            if len(output_str) > 0:
-                output_str += ", "
-            if qualifier is not None:
-                output_str += f"{qualifier}.{quote_str(field)}"
-            else:
-                output_str += quote_str(field)
-        return output_str
-    else:
+    if values is None:
         return None
+    if qualifier is not None:
+        return ", ".join([f"{qualifier}.{quote_str(field)}" for field in values])
+    return ", ".join([quote_str(field) for field in values])
+
+
+_NOTHING = object()
 
 
 def empty(iterable: Iterable[any]):
     if iterable is None:
         return True
-    it = iter(iterable)
-    return next(it, None) is None
+    return next(iter(iterable), _NOTHING) is _NOTHING
 
 
 def get_first(iterable: Iterable[any]):
     if iterable is None:
-        return True
-    it = iter(iterable)
-    return next(it, None)
+        return None
+    return next(iter(iterable), None)
 
 
 def get_count(iterable: Iterable[any]):
     if iterable is None:
         return 0
-    it = iter(iterable)
-    count = 0
-    while next(it, None):
-        count += 1
-    return count
+    if isinstance(iterable, Sized):
+        return len(iterable)
+    return sum(1 for _ in iterable)
@@ -1,7 +1,11 @@
 import logging
+import tempfile
 import unittest
 
 import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+from deltalake import DeltaTable, write_deltalake
 
 from rtdi_ducktape.CDCTransforms import Comparison
 from rtdi_ducktape.Dataflow import Dataflow
@@ -49,6 +53,115 @@ class DuckDBTests(unittest.TestCase):
         expected = {('eF43a70995dabAB', 'Terrance'), ('56b3cEA1E6A49F1', 'Barry')}
         self.assertEqual(actual, expected, "Datasets are different")
 
+    def test_partition_overwrite_generated_key(self):
+        """
+        A partition overwrite would assign new generated keys to the existing rows, the merge must be used instead
+        """
+        con = duckdb.connect()
+        con.execute("create table gk_source as (SELECT id, 'name ' || id as name, 'X' as region, null::int as gk "
+                    "FROM range(1, 11) t(id))")
+        with tempfile.TemporaryDirectory() as root_url:
+            df = Dataflow()
+            source_table = df.add(Table('gk_source', 'gk_source'))
+            target_table = df.add(DeltaLakeTable(root_url, source_table, "gk_target", pk_list=['id'],
+                                                 partition_cols=['region'], partition_overwrite_threshold=0.5,
+                                                 generated_key_column='gk', logger=logger))
+            target_table.add_all_columns(source_table, con)
+            target_table.create_table(con)
+            df.start(con)
+            df.start(con)
+            actual = DeltaTable(f"{root_url}/gk_target").to_pyarrow_table().sort_by("id").select(["id", "gk"])
+            self.assertEqual([{"id": i, "gk": i} for i in range(1, 11)], actual.to_pylist())
+        con.close()
+
+    def test_max_from_statistics_without_stats(self):
+        """
+        A file written without column statistics must cause a scan instead of ignoring its values
+        """
+        with tempfile.TemporaryDirectory() as root_url:
+            write_deltalake(f"{root_url}/stats_target", pa.table({"gk": [1, 9], "id": [1, 2]}),
+                            configuration={"delta.dataSkippingNumIndexedCols": "0"})
+            DeltaTable(f"{root_url}/stats_target").alter.set_table_properties(
+                {"delta.dataSkippingNumIndexedCols": "1"})
+            write_deltalake(f"{root_url}/stats_target", pa.table({"gk": [7], "id": [3]}), mode="append")
+            target_table = DeltaLakeTable(root_url, Table('stats_source', 'stats_source'), "stats_target",
+                                          generated_key_column='gk', logger=logger)
+            self.assertEqual((False, None), target_table.get_max_from_statistics('gk'))
+
+            write_deltalake(f"{root_url}/stats_complete", pa.table({"gk": [1, 9], "id": [1, 2]}))
+            write_deltalake(f"{root_url}/stats_complete", pa.table({"gk": [None, 7], "id": [3, 4]}), mode="append")
+            target_table = DeltaLakeTable(root_url, Table('stats_source', 'stats_source'), "stats_complete",
+                                          generated_key_column='gk', logger=logger)
+            self.assertEqual((True, 9), target_table.get_max_from_statistics('gk'))
+
+    def test_partition_merge_pruning(self):
+        """
+        The merge must read and rewrite only the files of the partitions present in the source data
+        """
+        con = duckdb.connect()
+        con.execute("create table p_source as (SELECT id, 'name ' || id as name, 2020 + id % 3 as year "
+                    "FROM range(1, 31) t(id))")
+        with tempfile.TemporaryDirectory() as root_url:
+            df = Dataflow()
+            source_table = df.add(Table('p_source', 'p_source'))
+            target_table = df.add(DeltaLakeTable(root_url, source_table, "p_target", pk_list=['id'],
+                                                 partition_cols=['year'], logger=logger))
+            target_table.add_all_columns(source_table, con)
+            target_table.create_table(con)
+            df.start(con)
+            files_before = {action["path"]: action["partition.year"] for action in
+                            pa.table(DeltaTable(f"{root_url}/p_target").get_add_actions(flatten=True)).to_pylist()}
+
+            con.execute("create or replace table p_source as (SELECT id, 'new ' || id as name, year "
+                        "FROM (values (2, 2022), (5, 2022), (40, 2022)) t(id, year))")
+            df.start(con)
+            dt = DeltaTable(f"{root_url}/p_target")
+            metrics = dt.history(1)[0]["operationMetrics"]
+            self.assertEqual(1, metrics["num_target_files_scanned"])
+            self.assertEqual(2, metrics["num_target_files_skipped_during_scan"])
+            self.assertEqual(1, metrics["num_target_files_removed"])
+            files_after = {action["path"]: action["partition.year"] for action in
+                           pa.table(dt.get_add_actions(flatten=True)).to_pylist()}
+            self.assertEqual({path for path, year in files_before.items() if year != 2022},
+                             {path for path, year in files_after.items() if year != 2022})
+
+            actual = dt.to_pyarrow_table().filter(pc.equal(pc.field("year"), 2022)).sort_by("id")
+            self.assertEqual(11, actual.num_rows)
+            self.assertEqual({2: 'new 2', 5: 'new 5', 8: 'name 8', 40: 'new 40'},
+                             {row["id"]: row["name"] for row in actual.to_pylist() if row["id"] in (2, 5, 8, 40)})
+        con.close()
+
+    def test_streamed_append_and_merge(self):
+        """
+        Sources larger than batch_rows are streamed into the delta table in several record batches
+        """
+        con = duckdb.connect()
+        con.execute("create table st_source as (SELECT id, 'name ' || id as name, 2020 + id % 3 as year "
+                    "FROM range(1, 31) t(id))")
+        with tempfile.TemporaryDirectory() as root_url:
+            source_table = Table('st_source', 'st_source')
+            append_table = DeltaLakeTable(root_url, source_table, "st_append", partition_cols=['year'],
+                                          batch_rows=4, logger=logger)
+            merge_table = DeltaLakeTable(root_url, source_table, "st_merge", pk_list=['id'],
+                                         partition_cols=['year'], batch_rows=4, logger=logger)
+            for target_table in (append_table, merge_table):
+                target_table.add_all_columns(source_table, con)
+                target_table.create_table(con)
+                target_table.execute(con)
+
+            con.execute("update st_source set name = 'new ' || id where id > 20")
+            append_table.execute(con)
+            merge_table.execute(con)
+
+            expected = con.execute("SELECT id, name, year FROM st_source order by id").fetchall()
+            actual = DeltaTable(f"{root_url}/st_merge").to_pyarrow_table().sort_by("id")
+            self.assertEqual(expected,
+                             [tuple(row.values()) for row in actual.select(["id", "name", "year"]).to_pylist()])
+            actual = DeltaTable(f"{root_url}/st_append").to_pyarrow_table()
+            self.assertEqual(60, actual.num_rows)
+            self.assertEqual(10, pc.sum(pc.starts_with(actual.column("name"), "new ")).as_py())
+        con.close()
+
 
 if __name__ == '__main__':
     unittest.main()
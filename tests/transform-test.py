@@ -1,72 +1,221 @@
 import logging
+import os
+import re
 import unittest
 from datetime import datetime
+from typing import Callable, Union
 
 import duckdb
+import pyarrow as pa
 
 from rtdi_ducktape.CDCTransforms import Comparison, SCD2
 from rtdi_ducktape.Dataflow import Dataflow
 from rtdi_ducktape.Loaders import DuckDBTable
-from rtdi_ducktape.Metadata import Table
+from rtdi_ducktape.Metadata import Table, Dataset, Query
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 logger = logging.getLogger("rtdi_ducktape")
 
+TERMINATION_DATE = datetime(9999, 12, 31)
+FLAG_TRUE_VALUES = {"1", "true", "yes", "on"}
+FLAG_FALSE_VALUES = {"0", "false", "no", "off"}
+# the files the tests may create and delete, e.g. the database of DUCKTAPE_STATE
+TESTDATA_DIR = os.path.realpath("testdata")
+
+
+def get_env_values(name: str, accepted: Callable[[str], bool], hint: str) -> set[str]:
+    """
+    The comma separated, lower case values of the environment variable, unknown values are an error instead of
+    silently being ignored
+    """
+    values = {value.strip().lower() for value in os.environ.get(name, "").split(",") if len(value.strip()) > 0}
+    unknown_values = sorted(value for value in values if not accepted(value))
+    if len(unknown_values) > 0:
+        raise ValueError(f"{name} contains the unknown values {unknown_values}, {hint}")
+    return values
+
+
+# printing the intermediate results costs extra queries, set DUCKTAPE_SHOW=1 (or true, yes, all) to see them after
+# every run of a dataflow or e.g. DUCKTAPE_SHOW=run2,run3 for specific runs only
+SHOW_ALL_VALUES = FLAG_TRUE_VALUES | {"all"}
+SHOW_NONE_VALUES = FLAG_FALSE_VALUES | {"none"}
+SHOW = get_env_values("DUCKTAPE_SHOW",
+                      lambda value: value in SHOW_ALL_VALUES or value in SHOW_NONE_VALUES
+                      or re.fullmatch(r"run\d+", value) is not None,
+                      f"use one of {sorted(SHOW_ALL_VALUES)} for all runs or run1, run2,... for specific runs")
+REPLAY = not get_env_values("DUCKTAPE_REPLAY",
+                            lambda value: value in FLAG_TRUE_VALUES or value in FLAG_FALSE_VALUES,
+                            f"use one of {sorted(FLAG_TRUE_VALUES)} or {sorted(FLAG_FALSE_VALUES)}"
+                            ).isdisjoint(FLAG_TRUE_VALUES)
+CUSTOMER_IDS = ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')
+# every dataflow is executed three times, with the baseline, the changes and the baseline again
+LOADS = ["csv_baseline", "csv_change", "csv_baseline"]
+
+
+def show_run(run: int) -> bool:
+    return not SHOW.isdisjoint(SHOW_ALL_VALUES) or f"run{run}" in SHOW
+
+
+class DuckDBTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.open(":memory:")
+
+    @classmethod
+    def open(cls, database: str):
+        # the csv files are parsed once, the tests copy the already loaded tables
+        # the results are compared as sets, DuckDB can keep the parallel pipelines out of order
+        cls.con = duckdb.connect(database, config={"preserve_insertion_order": False})
+        cls.con.execute(f"create table csv_baseline as (SELECT * FROM '{cls.get_test_data('customers-100000')}')")
+        cls.con.execute(f"create table csv_change as (SELECT * FROM "
+                        f"'{cls.get_test_data('customers-100000_change_01')}')")
+        # both files have the same columns, the source tables of the tests use this schema instead of reading it
+        cls.csv_schema = cls.con.table("csv_baseline").limit(0).arrow().schema
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.con.close()
+
+    @classmethod
+    def get_test_data(cls, name: str) -> str:
+        """
+        The parquet copy of the csv file in testdata, which is created on first use and whenever the csv is newer.
+        Reading the parquet file skips the csv sniffing and parsing in later test sessions. The copy is written
+        to a file of this process and renamed, so parallel test processes never read a partially written file.
+        """
+        csv_file = f"testdata/{name}.csv"
+        parquet_file = f"testdata/{name}.parquet"
+        if not os.path.exists(parquet_file) or os.path.getmtime(parquet_file) < os.path.getmtime(csv_file):
+            temp_file = f"{parquet_file}.{os.getpid()}.tmp"
+            try:
+                cls.con.execute(f"COPY (FROM '{csv_file}') TO '{temp_file}' (FORMAT PARQUET)")
+                os.replace(temp_file, parquet_file)
+            finally:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+        return parquet_file
+
+    @classmethod
+    def load(cls, df: Dataflow, run: int, source: str, shown: list[Dataset], projection: str = "*"):
+        """
+        Replace the csv_data table with the rows of the source table and execute the dataflow
+        """
+        cls.con.execute(f"create or replace table csv_data as (SELECT {projection} FROM {source})")
+        df.start(cls.con)
+        if show_run(run):
+            for dataset in shown:
+                dataset.show(cls.con, logger, f"{dataset.name} after run {run} with {source}")
 
-class DuckDBTests(unittest.TestCase):
-
-    def test_scd2(self):
-        termination_date = datetime.strptime('9999-12-31', '%Y-%m-%d').replace(tzinfo=None)
-
-        duckdb.execute("create or replace table csv_data as (SELECT * FROM 'testdata/customers-100000.csv')")
+    def assert_rows(self, sql: str, params: Union[None, list], expected: set[tuple]):
+        """
+        Compare the rows of the query with the expected rows within DuckDB, the rows missing on either side
+        are counted. The columns are matched by position.
+        """
+        columns = [list(values) for values in zip(*expected)]
+        self.con.register("expected", pa.table(columns, names=[f"c{i}" for i in range(len(columns))]))
+        try:
+            compare_sql = f"""with actual as ({sql}), expected as (from expected)
+                   select (select count(*) from (from actual except from expected))
+                        + (select count(*) from (from expected except from actual))"""
+            differences = self.con.execute(compare_sql, params).fetchone()[0]
+        finally:
+            self.con.unregister("expected")
+        if differences > 0:
+            self.fail(f"Datasets are different: {set(self.con.execute(sql, params).fetchall())}")
+
+    def assert_show_data(self, dataset, expected: set[tuple]):
+        self.assert_rows(dataset.get_show_sql(), dataset.where_params, expected)
+
+
+class SCD2Tests(DuckDBTestCase):
+    """
+    The three loads are executed once, each test checks the target table as it was after one of the loads
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # With DUCKTAPE_STATE=<file> the database is kept in that file. Setting DUCKTAPE_REPLAY=1 in addition reuses
+        # the snapshot tables of the previous session and executes the assertions only.
+        state = os.environ.get("DUCKTAPE_STATE")
+        if state is not None and os.path.dirname(os.path.realpath(state)) != TESTDATA_DIR:
+            # the file is deleted before every session, it must not be possible to point it to another file
+            raise ValueError(f"DUCKTAPE_STATE must be a file in {TESTDATA_DIR}, not {state}")
+        if state is not None and REPLAY and os.path.exists(state):
+            cls.con = duckdb.connect(state)
+            return
+        if state is not None:
+            for file in (state, state + ".wal"):
+                if os.path.exists(file):
+                    os.remove(file)
+        cls.open(state or ":memory:")
         df = Dataflow()
         source_table = df.add(Table('csv_data', 'csv_data', pk_list=['Customer Id']))
         tc = df.add(Comparison(source_table, end_date_column="end_date",
-                               termination_date=termination_date,
+                               termination_date=TERMINATION_DATE,
                                detect_deletes=True, order_column="version_id", logger=logger))
 
         scd2 = df.add(SCD2(tc, 'start_date', 'end_date',
-                    termination_date=termination_date,
+                    termination_date=TERMINATION_DATE,
                     current_flag_column='current', current_flag_set='Y', current_flag_unset='N', logger=logger))
         target_table = df.add(DuckDBTable(scd2, "customer_output", generated_key_column='version_id', logger=logger))
-        target_table.add_all_columns(source_table, duckdb)
+        source_table.schema = cls.csv_schema
+        target_table.add_all_columns(source_table, cls.con)
         scd2.add_default_columns(target_table)
         target_table.add_default_columns()
-        target_table.create_table(duckdb)
+        target_table.create_table(cls.con)
         tc.set_comparison_table(target_table)
 
         source_table.set_show_columns(
             ['"Customer Id"', '"First Name"'])
-        source_table.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
+        source_table.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
 
         tc.set_show_columns(
             ['"Customer Id"', '"First Name"', "version_id", "start_date", "end_date", "current", "__change_type"])
-        tc.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
+        tc.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
 
         target_table.set_show_columns(
             ['"Customer Id"', '"First Name"', "version_id", "start_date", "end_date", "current"])
-        target_table.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
-
-        source_table.show(duckdb, logger, "Source")
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
-
-        duckdb.execute("create or replace table csv_data as (SELECT * FROM 'testdata/customers-100000_change_01.csv')")
-        source_table.show(duckdb, logger, "Source")
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
-
-        duckdb.execute("create or replace table csv_data as (SELECT * FROM 'testdata/customers-100000.csv')")
-        source_table.show(duckdb, logger, "Source")
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
+        target_table.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
 
+        for run, source in enumerate(LOADS, start=1):
+            cls.load(df, run, source, [source_table, tc, target_table])
+            # keep the state after each load for the tests
+            cls.con.execute(f"create table scd2_run{run} as (SELECT \"Customer Id\", \"First Name\", start_date, "
+                            f"end_date, current FROM customer_output where \"Customer Id\" in (?, ?, ?))",
+                            CUSTOMER_IDS)
+
+    def get_dates(self, run: int) -> list[datetime]:
+        """
+        The distinct start and end dates of the target table after the load, in ascending order
+        """
+        return [row[0] for row in self.con.execute(
+            f"select distinct d from (select start_date as d from scd2_run{run} "
+            f"union all select end_date from scd2_run{run}) order by d").fetchall()]
+
+    def test_after_run1(self):
+        dates = self.get_dates(1)
+        expected = {
+            ('56b3cEA1E6A49F1', 'Barry',    dates[0], dates[1], 'Y'),
+            ('eF43a70995dabAB', 'Terrance', dates[0], dates[1], 'Y')
+        }
+        self.assert_rows("from scd2_run1", None, expected)
+
+    def test_after_run2(self):
+        dates = self.get_dates(2)
+        expected = {
+            # run 1: record was created, run 2: firstname changed
+            ('56b3cEA1E6A49F1', 'Barry',    dates[0], dates[1], 'N'),
+            # run 1: record was created, run 2 record got deleted
+            ('eF43a70995dabAB', 'Terrance', dates[0], dates[1], 'N'),
+            # run 2: record was created
+            ('FaE5E3c1Ea0dAf6', 'Fritz',    dates[1], dates[2], 'Y'),
+            # run 2: firstname changed
+            ('56b3cEA1E6A49F1', 'Berry',    dates[1], dates[2], 'Y')
+        }
+        self.assert_rows("from scd2_run2", None, expected)
+
+    def test_after_run3(self):
         # ┌─────────────────┬────────────┬────────────────────────────┬────────────────────────────┬─────────┐
         # │   Customer Id   │ First Name │         start_date         │          end_date          │ current │
         # │     varchar     │  varchar   │         timestamp          │         timestamp          │ varchar │
@@ -78,116 +227,85 @@ class DuckDBTests(unittest.TestCase):
         # │ eF43a70995dabAB │ Terrance   │ 2025-08-09 19:01:44.369191 │ 9999-12-31 00:00:00        │ Y       │
         # │ 56b3cEA1E6A49F1 │ Barry      │ 2025-08-09 19:01:44.369191 │ 9999-12-31 00:00:00        │ Y       │
         # └─────────────────┴────────────┴────────────────────────────┴────────────────────────────┴─────────┘
-        target_table.set_show_columns(['"Customer Id"', '"First Name"', "start_date", "end_date", "current"])
-        actual = set(target_table.get_show_data(duckdb))
-        start_dates = {row[2] for row in actual}
-        start_dates = start_dates.union({row[3] for row in actual})
-        sorted_start_dates = sorted(start_dates)
+        dates = self.get_dates(3)
         expected = {
             # run 1: record was created
-            ('56b3cEA1E6A49F1', 'Barry',    sorted_start_dates[0], sorted_start_dates[1], 'N'),
+            ('56b3cEA1E6A49F1', 'Barry',    dates[0], dates[1], 'N'),
             # run 1: record was created, run 2 record got deleted
-            ('eF43a70995dabAB', 'Terrance', sorted_start_dates[0], sorted_start_dates[1], 'N'),
+            ('eF43a70995dabAB', 'Terrance', dates[0], dates[1], 'N'),
             # run 2: record was created
-            ('FaE5E3c1Ea0dAf6', 'Fritz',    sorted_start_dates[1], sorted_start_dates[2], 'N'),
+            ('FaE5E3c1Ea0dAf6', 'Fritz',    dates[1], dates[2], 'N'),
             # run 2: firstname changed
-            ('56b3cEA1E6A49F1', 'Berry',    sorted_start_dates[1], sorted_start_dates[2], 'N'),
+            ('56b3cEA1E6A49F1', 'Berry',    dates[1], dates[2], 'N'),
             # run 3: record was created again
-            ('eF43a70995dabAB', 'Terrance', sorted_start_dates[2], sorted_start_dates[3], 'Y'),
+            ('eF43a70995dabAB', 'Terrance', dates[2], dates[3], 'Y'),
             # run 3: firstname changed back to the original value
-            ('56b3cEA1E6A49F1', 'Barry',    sorted_start_dates[2], sorted_start_dates[3], 'Y')
+            ('56b3cEA1E6A49F1', 'Barry',    dates[2], dates[3], 'Y')
         }
-        self.assertEqual(actual, expected, "Datasets are different")
+        self.assert_rows("from scd2_run3", None, expected)
+
+
+class DuckDBTests(DuckDBTestCase):
 
     def test_tc_same(self):
         """
         Target table has the same fields and a primary key specified
         :return:
         """
-        duckdb.execute("create or replace table csv_data as (SELECT * FROM 'testdata/customers-100000.csv')")
+        self.con.execute("create or replace table csv_data as (SELECT * FROM csv_baseline)")
         df = Dataflow()
         source_table = df.add(Table('csv_data', 'csv_data', pk_list=['Customer Id']))
         tc = df.add(Comparison(source_table, detect_deletes=True, logger=logger))
 
         target_table = df.add(DuckDBTable(tc, "customer_output", pk_list=['Customer Id'], logger=logger))
-        target_table.add_all_columns(source_table, duckdb)
-        target_table.create_table(duckdb)
+        source_table.schema = self.csv_schema
+        target_table.add_all_columns(source_table, self.con)
+        target_table.create_table(self.con)
         tc.set_comparison_table(target_table)
 
         tc.set_show_columns(
             ['"Customer Id"', '"First Name"', "__change_type"])
-        tc.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
+        tc.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
 
         target_table.set_show_columns(
             ['"Customer Id"', '"First Name"'])
-        target_table.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
-
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
+        target_table.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
 
-        duckdb.execute("create or replace table csv_data as (SELECT * FROM 'testdata/customers-100000_change_01.csv')")
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
+        for run, source in enumerate(LOADS, start=1):
+            self.load(df, run, source, [tc, target_table])
 
-        duckdb.execute("create or replace table csv_data as (SELECT * FROM 'testdata/customers-100000.csv')")
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
-
-        actual = set(target_table.get_show_data(duckdb))
-        expected = {('eF43a70995dabAB', 'Terrance'), ('56b3cEA1E6A49F1', 'Barry')}
-        self.assertEqual(actual, expected, "Datasets are different")
+        actual = target_table.get_show_data_arrow(self.con).sort_by("Customer Id")
+        expected = pa.table({"Customer Id": ['56b3cEA1E6A49F1', 'eF43a70995dabAB'], "First Name": ['Barry', 'Terrance']})
+        self.assertTrue(actual.equals(expected), f"Datasets are different: {actual.to_pylist()}")
 
     def test_tc_with_history(self):
         """
         Target table has the same fields and a primary key specified
         :return:
         """
-        duckdb.execute("create or replace table csv_data as (SELECT *, '?' as __change_type, "
-                       "current_localtimestamp() as change_date FROM 'testdata/customers-100000.csv')")
+        self.con.execute("create or replace table csv_data as (SELECT *, '?' as __change_type, "
+                       "current_localtimestamp() as change_date FROM csv_baseline)")
         df = Dataflow()
         source_table = df.add(Table('csv_data', 'csv_data'))
         tc = df.add(Comparison(source_table, detect_deletes=True, logical_pk_list=['Customer Id'],
                                columns_to_ignore=['change_date'], order_column='change_date', logger=logger))
-        duckdb.execute("create or replace table customer_output as (SELECT * FROM csv_data) with no data")
+        self.con.execute("create or replace table customer_output as (SELECT * FROM csv_data) with no data")
 
         target_table = df.add(DuckDBTable(tc, "customer_output", logger=logger))
         tc.set_comparison_table(target_table)
 
         tc.set_show_columns(
             ['"Customer Id"', '"First Name"', "__change_type"])
-        tc.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
+        tc.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
 
         target_table.set_show_columns(
             ['"Customer Id"', '"First Name"', "__change_type"])
-        target_table.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
-
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
-        tc.completed()
-
-        duckdb.execute("create or replace table csv_data as (SELECT *, '?' as __change_type, "
-                       "current_localtimestamp() as change_date FROM 'testdata/customers-100000_change_01.csv')")
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
-        tc.completed()
-
-        duckdb.execute("create or replace table csv_data as (SELECT *, '?' as __change_type, "
-                       "current_localtimestamp() as change_date FROM 'testdata/customers-100000.csv')")
-        df.start(duckdb)
-        tc.show(duckdb, logger, "CDC table after execution")
-        target_table.show(duckdb, logger, "Target table after apply")
-        tc.completed()
-
-        actual = set(target_table.get_show_data(duckdb))
+        target_table.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
+
+        for run, source in enumerate(LOADS, start=1):
+            self.load(df, run, source, [tc, target_table],
+                      "*, '?' as __change_type, current_localtimestamp() as change_date")
+
         # ├─────────────────┼────────────┼───────────────┤
         # │ 56b3cEA1E6A49F1 │ Barry      │ I             │
         # │ eF43a70995dabAB │ Terrance   │ I             │
@@ -209,36 +327,220 @@ class DuckDBTests(unittest.TestCase):
              ('eF43a70995dabAB', 'Terrance', 'D'),
              ('eF43a70995dabAB', 'Terrance', 'I')
         }
-        self.assertEqual(actual, expected, "Datasets are different")
+        self.assert_show_data(target_table, expected)
+
+    def test_tc_settings_changed(self):
+        """
+        Changing the primary key or a flag of the Comparison between two executions must generate new statements
+        """
+        self.con.execute("create or replace table tc_source as (SELECT * FROM (values (1, 'a', 'x'), (2, 'b', 'y')) "
+                         "t(id, name, city))")
+        self.con.execute("create or replace table tc_target as (SELECT * FROM (values (1, 'a', 'x'), (3, 'c', 'z')) "
+                         "t(id, name, city))")
+        df = Dataflow()
+        source_table = df.add(Table('tc_source', 'tc_source', pk_list=['id']))
+        tc = df.add(Comparison(source_table, logger=logger))
+        tc.set_comparison_table(Table('tc_target', 'tc_target'))
+        changes_sql = "SELECT id, name, __change_type FROM tc_source_tc"
+
+        df.start(self.con)
+        self.assertEqual({(2, 'b', 'I')}, set(self.con.execute(changes_sql).fetchall()))
+
+        tc.detect_deletes = True
+        df.start(self.con)
+        self.assertEqual({(2, 'b', 'I'), (3, 'c', 'D')}, set(self.con.execute(changes_sql).fetchall()))
+
+        # with the city as key, the changed city of id 1 is a new key and its old city a deleted one
+        self.con.execute("update tc_source set city = 'w' where id = 1")
+        tc.pk_list = ['city']
+        df.start(self.con)
+        self.assertEqual({(1, 'a', 'I'), (2, 'b', 'I'), (1, 'a', 'D'), (3, 'c', 'D')},
+                         set(self.con.execute(changes_sql).fetchall()))
+
+    def test_tc_materialized_ctes(self):
+        """
+        Without delete detection the comparison table must not be materialized, else it would be read in full
+        instead of only the rows matching a source primary key
+        """
+        self.con.execute("create or replace table tc_source as (SELECT * FROM (values (1, 'a'), (2, 'b')) t(id, name))")
+        self.con.execute("create or replace table tc_target as (SELECT * FROM (values (1, 'a'), (3, 'c')) t(id, name))")
+        tc = Comparison(Table('tc_source', 'tc_source', pk_list=['id']), materialize_ctes=True, logger=logger)
+        tc.set_comparison_table(Table('tc_target', 'tc_target'))
+
+        _, delta_sql = tc._compile(self.con, False)
+        self.assertIn('comparison_table as (select * from "tc_target")', delta_sql)
+        self.assertIn('source as materialized (select * from "tc_source")', delta_sql)
+        self.assertIn('from comparison_table where ("id") in (select "id" from source_pks)', delta_sql)
+
+        tc.detect_deletes = True
+        _, delta_sql = tc._compile(self.con, False)
+        self.assertIn('comparison_table as materialized (select * from "tc_target")', delta_sql)
+
+    def test_query_placeholder_names(self):
+        """
+        Input dataset names are not limited to word characters, struct literals are no placeholders
+        """
+        self.con.execute("create or replace table q_source as (SELECT * FROM (values (1, 'a'), (2, 'b')) t(id, name))")
+        query = Query('q_result', "SELECT id, {'name': name} as s FROM {my-src} where id > 1",
+                      [Table('my-src', 'q_source')])
+        self.assertEqual('(SELECT id, {\'name\': name} as s FROM (select * from "q_source") where id > 1)',
+                         query.get_sub_select_clause())
+        self.assertEqual([(2, {'name': 'b'})],
+                         self.con.sql(f"select * from {query.get_sub_select_clause()}").fetchall())
+
+    def test_create_table_types(self):
+        """
+        The columns created from an Arrow schema must have the types DuckDB uses when importing the Arrow data
+        """
+        schema = pa.schema([
+            ("bool", pa.bool_()), ("int8", pa.int8()), ("uint64", pa.uint64()), ("float", pa.float32()),
+            ("large_string", pa.large_string()), ("binary", pa.binary()), ("date64", pa.date64()),
+            ("null", pa.null()), ("ts_s", pa.timestamp("s")), ("ts_ns", pa.timestamp("ns")),
+            ("ts_tz", pa.timestamp("us", tz="UTC")), ("time32", pa.time32("ms")), ("time_ns", pa.time64("ns")),
+            ("duration", pa.duration("us")), ("interval", pa.month_day_nano_interval()),
+            ("decimal", pa.decimal128(18, 3)), ("fixed_binary", pa.binary(4)),
+            ("dictionary", pa.dictionary(pa.int32(), pa.string())), ("fixed_list", pa.list_(pa.int32(), 3)),
+            ("map", pa.map_(pa.string(), pa.int64())), ("large_list", pa.large_list(pa.int16())),
+            ("struct", pa.struct([("a b", pa.int32()), ("c", pa.list_(pa.float64()))])),
+        ])
+        table = Table('types_ddl', 'types_ddl')
+        table.schema = schema
+        table.create_table(self.con)
+        self.con.from_arrow(schema.empty_table()).create("types_arrow")
+        types_sql = ("SELECT column_name, data_type FROM duckdb_columns() where table_name = ? "
+                     "order by column_index")
+        self.assertEqual(self.con.execute(types_sql, ["types_arrow"]).fetchall(),
+                         self.con.execute(types_sql, ["types_ddl"]).fetchall())
+
+    def test_query_unknown_placeholder(self):
+        """
+        A placeholder without a matching input dataset is reported when the query is defined
+        """
+        with self.assertRaisesRegex(RuntimeError, r"\['missing'\]"):
+            Query('q_result', "SELECT * FROM {q_source} join {missing} using (id)", [Table('q_source', 'q_source')])
+        with self.assertRaisesRegex(RuntimeError, "no input datasets"):
+            Query('q_result', "SELECT * FROM {q_source}")
+
+    def test_query_invalidate_sub_select(self):
+        """
+        The sub select of a query is cached, invalidating an input must render all queries using it again
+        """
+        inner = Query('inner', "SELECT 1 as id")
+        middle = Query('middle', "SELECT * FROM {inner}", [inner])
+        outer = Query('outer', "SELECT * FROM {middle}", [middle])
+        self.assertEqual("(SELECT * FROM (SELECT * FROM (SELECT 1 as id)))", outer.get_sub_select_clause())
+
+        inner.sql = "SELECT 2 as id"
+        self.assertEqual("(SELECT * FROM (SELECT * FROM (SELECT 1 as id)))", outer.get_sub_select_clause())
+        inner.invalidate_sub_select_clause()
+        self.assertEqual("(SELECT * FROM (SELECT * FROM (SELECT 2 as id)))", outer.get_sub_select_clause())
+
+        middle.set_inputs([Query('inner', "SELECT 3 as id")])
+        self.assertEqual("(SELECT * FROM (SELECT * FROM (SELECT 3 as id)))", outer.get_sub_select_clause())
 
     def test_upsert(self):
         """
         Target table has the same fields and a primary key specified
         :return:
         """
-        duckdb.execute("create or replace table csv_data as (SELECT * FROM 'testdata/customers-100000.csv')")
-        duckdb.execute("alter table csv_data add primary key (\"Customer Id\")")
-        duckdb.execute("create or replace table csv_data_copy as (SELECT * FROM csv_data) with no data")
-        duckdb.execute("alter table csv_data_copy add primary key (\"Customer Id\")")
+        self.con.execute("create or replace table csv_data as (SELECT * FROM csv_baseline)")
+        self.con.execute("alter table csv_data add primary key (\"Customer Id\")")
+        self.con.execute("create or replace table csv_data_copy as (SELECT * FROM csv_data) with no data")
+        self.con.execute("alter table csv_data_copy add primary key (\"Customer Id\")")
         df = Dataflow()
         source_table = df.add(Table('csv_data', 'csv_data'))
         target_table = df.add(DuckDBTable(source_table, "csv_data_copy", logger=logger))
 
         target_table.set_show_columns(
             ['"Customer Id"', '"First Name"'])
-        target_table.set_show_where_clause(
-            "\"Customer Id\" in ('FaE5E3c1Ea0dAf6', '56b3cEA1E6A49F1', 'eF43a70995dabAB')")
+        target_table.set_show_where_clause('"Customer Id" in (?, ?, ?)', CUSTOMER_IDS)
 
-        df.start(duckdb)
-        target_table.show(duckdb, logger, "Target table after apply")
+        df.start(self.con)
+        if show_run(1):
+            target_table.show(self.con, logger, "Target table after apply")
 
-        df.start(duckdb)
-        target_table.show(duckdb, logger, "Target table after apply")
+        df.start(self.con)
+        if show_run(2):
+            target_table.show(self.con, logger, "Target table after apply")
 
-        actual = set(target_table.get_show_data(duckdb))
-        expected = {('eF43a70995dabAB', 'Terrance'), ('56b3cEA1E6A49F1', 'Barry')}
-        self.assertEqual(actual, expected, "Datasets are different")
+        actual = target_table.get_show_data_arrow(self.con).sort_by("Customer Id")
+        expected = pa.table({"Customer Id": ['56b3cEA1E6A49F1', 'eF43a70995dabAB'], "First Name": ['Barry', 'Terrance']})
+        self.assertTrue(actual.equals(expected), f"Datasets are different: {actual.to_pylist()}")
 
 
+    def test_upsert_logical_pk(self):
+        """
+        Target table without a primary key, the rows are upserted via the logical primary key
+        """
+        self.con.execute("create or replace table lpk_source as (SELECT * FROM (values (2, 'B'), (3, 'c')) "
+                         "t(id, name))")
+        self.con.execute("create or replace table lpk_target as (SELECT * FROM (values (1, 'a'), (2, 'b')) "
+                         "t(id, name))")
+        df = Dataflow()
+        source_table = df.add(Table('lpk_source', 'lpk_source'))
+        target_table = df.add(DuckDBTable(source_table, "lpk_target", pk_list=['id'], logger=logger))
+
+        df.start(self.con)
+        self.assertEqual(2, target_table.last_execution.rows_processed)
+        # id 1 is kept, id 2 updated and id 3 inserted
+        self.assert_rows("SELECT id, name FROM lpk_target", None, {(1, 'a'), (2, 'B'), (3, 'c')})
+
+        # a second execution updates the same rows again without inserting duplicates
+        df.start(self.con)
+        self.assert_rows("SELECT id, name FROM lpk_target", None, {(1, 'a'), (2, 'B'), (3, 'c')})
+        self.assertEqual(3, self.con.execute("SELECT count(*) FROM lpk_target").fetchone()[0])
+
+    def test_parallel_diamond(self):
+        """
+        Two branches read the same source and are joined again, with several workers the join must still be
+        executed after both branches
+        """
+        self.con.execute("create or replace table dm_source as (SELECT range as id FROM range(1000))")
+        for name in ("dm_even", "dm_odd", "dm_result"):
+            self.con.execute(f"create or replace table {name} (id bigint, kind varchar)")
+        df = Dataflow(max_workers=4)
+        source_table = df.add(Table('dm_source', 'dm_source'))
+        even = df.add(Query('even', "SELECT id, 'even' as kind FROM {dm_source} where id % 2 = 0", [source_table]))
+        odd = df.add(Query('odd', "SELECT id, 'odd' as kind FROM {dm_source} where id % 2 = 1", [source_table]))
+        even_table = df.add(DuckDBTable(even, "dm_even", "dm_even", logger=logger))
+        odd_table = df.add(DuckDBTable(odd, "dm_odd", "dm_odd", logger=logger))
+        union = df.add(Query('union', "SELECT * FROM {dm_even} union all SELECT * FROM {dm_odd}",
+                             [even_table, odd_table]))
+        result_table = df.add(DuckDBTable(union, "dm_result", logger=logger))
+
+        order = df.topological_order()
+        self.assertLess(order.index(even_table), order.index(result_table))
+        self.assertLess(order.index(odd_table), order.index(result_table))
+        df.start(self.con)
+        self.assert_rows("SELECT kind, count(*), sum(id) FROM dm_result group by kind", None,
+                         {('even', 500, 249500), ('odd', 500, 250000)})
+
+    def test_topological_order_ties(self):
+        """
+        Steps ready at the same time are ordered by the number of outputs, then by name, independent of the
+        order they were added in
+        """
+        df = Dataflow()
+        source = df.add(Query('source', "SELECT 1 as id"))
+        for name in ("c", "a", "b"):
+            df.add(Query(name, "SELECT * FROM {source}", [source]))
+        shared = df.add(Query('z', "SELECT * FROM {source}", [source]))
+        for name in ("y2", "y1"):
+            df.add(Query(name, "SELECT * FROM {z}", [shared]))
+        self.assertEqual(["source", "z", "a", "b", "c", "y1", "y2"], [step.name for step in df.topological_order()])
+
+    def test_cycle(self):
+        """
+        A dataflow whose steps depend on each other cannot be executed
+        """
+        df = Dataflow()
+        first = df.add(Query('first', "SELECT 1 as id"))
+        second = df.add(Query('second', "SELECT * FROM {first}", [first]))
+        first.add_input(second)
+        with self.assertRaises(RuntimeError):
+            df.topological_order()
+        with self.assertRaises(RuntimeError):
+            df.start(self.con)
+
 if __name__ == '__main__':
     unittest.main()